@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+⏱️ BENCHMARK - Audio I/O (save_wav_file, merge_wav_files)
+
+Sinh PCM 16-bit mono 24 kHz tổng hợp, rồi đo từng pha:
+✅ write          - save_wav_file cho từng chunk
+✅ merge          - merge_wav_files (hàm MainWindow.merge_audio dùng)
+✅ merge_streamed - phương án so sánh: ghép theo khối, không đọc cả file vào RAM
+✅ reread_chunks / reread_merged - đọc lại toàn bộ audio
+
+Mỗi pha chạy trong tiến trình con riêng để peak RSS không bị pha trước ảnh hưởng; ghi lại wall time,
+syscall đọc/ghi và số byte (/proc/self/io, Linux) và peak RSS (resource).
+
+Dùng:
+    python benchmarks/bench_audio_io.py --chunks 500 --chunk-seconds 8 --output audio_baseline.json
+    python benchmarks/bench_audio_io.py --chunks 2000 --chunk-seconds 10 --compare audio_baseline.json
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+from array import array
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SAMPLE_RATE = 24000
+SAMPLE_WIDTH = 2
+CHANNELS = 1
+READ_BLOCK_FRAMES = 64 * 1024
+PHASES = ["write", "merge", "merge_streamed", "reread_chunks", "reread_merged"]
+
+
+# =====================================
+# MEASUREMENT
+# =====================================
+
+def read_proc_io():
+    """Bộ đếm I/O của tiến trình (Linux), None nếu không có"""
+    try:
+        with open("/proc/self/io", "r") as f:
+            return {k: int(v) for k, v in (line.split(":") for line in f if ":" in line)}
+    except OSError:
+        return None
+
+
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux: KB, macOS: bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def synth_chunk(seconds, index):
+    n = int(seconds * SAMPLE_RATE)
+    step = 2 * math.pi * (200 + index % 50) / SAMPLE_RATE
+    return array('h', (int(6000 * math.sin(i * step)) for i in range(n))).tobytes()
+
+
+def chunk_paths(workdir, chunks):
+    return [os.path.join(workdir, f"chunk_{i+1:05d}.wav") for i in range(chunks)]
+
+
+# =====================================
+# PHASES (chạy trong tiến trình con)
+# =====================================
+
+def merge_streamed(input_files, output_file):
+    """Phương án so sánh: copy theo khối READ_BLOCK_FRAMES, RAM cố định"""
+    with wave.open(output_file, 'wb') as output:
+        for i, file_path in enumerate(input_files):
+            with wave.open(file_path, 'rb') as input_file:
+                if i == 0:
+                    output.setparams(input_file.getparams())
+                while True:
+                    frames = input_file.readframes(READ_BLOCK_FRAMES)
+                    if not frames:
+                        break
+                    output.writeframesraw(frames)
+    return output_file
+
+
+def prepare_phase(phase, chunk_seconds):
+    """Chuẩn bị trước khi lấy mốc RSS / I/O: import tts và sinh mẫu PCM cho pha write"""
+    import tts
+
+    context = {"tts": tts}
+    if phase == "write":
+        # Vài mẫu PCM khác nhau, tái sử dụng - chỉ đo ghi, không đo sinh dữ liệu
+        context["samples"] = [synth_chunk(chunk_seconds, i) for i in range(4)]
+    return context
+
+
+def run_phase(phase, workdir, chunks, context):
+    tts = context["tts"]
+    paths = chunk_paths(workdir, chunks)
+    merged = os.path.join(workdir, "merged.wav")
+    payload_bytes = 0
+
+    if phase == "write":
+        samples = context["samples"]
+        start = time.perf_counter()
+        for i, path in enumerate(paths):
+            data = samples[i % len(samples)]
+            if not tts.save_wav_file(path, data, CHANNELS, SAMPLE_RATE, SAMPLE_WIDTH):
+                raise RuntimeError(f"save_wav_file thất bại: {path}")
+            payload_bytes += len(data)
+    elif phase in ("merge", "merge_streamed"):
+        target = merged if phase == "merge" else os.path.join(workdir, "merged_streamed.wav")
+        start = time.perf_counter()
+        if phase == "merge":
+            tts.merge_wav_files(paths, target)
+        else:
+            merge_streamed(paths, target)
+        with wave.open(target, 'rb') as wf:
+            payload_bytes = wf.getnframes() * wf.getsampwidth() * wf.getnchannels()
+    elif phase == "reread_chunks":
+        start = time.perf_counter()
+        for path in paths:
+            with wave.open(path, 'rb') as wf:
+                payload_bytes += len(wf.readframes(wf.getnframes()))
+    elif phase == "reread_merged":
+        start = time.perf_counter()
+        with wave.open(merged, 'rb') as wf:
+            while True:
+                frames = wf.readframes(READ_BLOCK_FRAMES)
+                if not frames:
+                    break
+                payload_bytes += len(frames)
+    else:
+        raise ValueError(f"Pha không hợp lệ: {phase}")
+
+    return time.perf_counter() - start, payload_bytes
+
+
+def child_main(args):
+    # Import tts (PyQt6, NumPy...) và sinh dữ liệu trước mốc đo, để delta chỉ gồm chính pha đó
+    context = prepare_phase(args.phase, args.chunk_seconds)
+    rss_before = peak_rss_bytes()
+    io_before = read_proc_io()
+    seconds, payload_bytes = run_phase(args.phase, args.workdir, args.chunks, context)
+    io_after = read_proc_io()
+    rss_after = peak_rss_bytes()
+
+    io_delta = None
+    if io_before is not None and io_after is not None:
+        io_delta = {k: io_after[k] - io_before.get(k, 0) for k in io_after}
+
+    print(json.dumps({
+        "phase": args.phase,
+        "wall_s": round(seconds, 4),
+        "payload_bytes": payload_bytes,
+        "mb_per_sec": round(payload_bytes / seconds / 1e6, 1) if seconds > 0 else None,
+        "io": io_delta,
+        "peak_rss_bytes": rss_after,
+        "peak_rss_delta_bytes": rss_after - rss_before if rss_after is not None else None,
+    }))
+    return 0
+
+
+# =====================================
+# DRIVER
+# =====================================
+
+def run_all(chunks, chunk_seconds, workdir, phases):
+    results = {}
+    for phase in phases:
+        print(f"⏱️ {phase}...", file=sys.stderr)
+        cmd = [sys.executable, os.path.abspath(__file__), "--phase", phase, "--workdir", workdir,
+               "--chunks", str(chunks), "--chunk-seconds", str(chunk_seconds)]
+        completed = subprocess.run(cmd, capture_output=True, text=True)
+        if completed.returncode != 0:
+            raise RuntimeError(f"Pha {phase} lỗi:\n{completed.stderr}")
+        results[phase] = json.loads(completed.stdout.strip().splitlines()[-1])
+    return results
+
+
+def compare(report, baseline, threshold):
+    regressions = []
+    for phase, current in report["results"].items():
+        base = baseline.get("results", {}).get(phase)
+        if not base:
+            continue
+        if base.get("wall_s") and current["wall_s"] > base["wall_s"] * (1 + threshold):
+            regressions.append(f"{phase}: {current['wall_s']}s > {base['wall_s']}s (+{threshold:.0%})")
+        base_rss = base.get("peak_rss_delta_bytes")
+        cur_rss = current.get("peak_rss_delta_bytes")
+        if base_rss and cur_rss and cur_rss > base_rss * (1 + threshold):
+            regressions.append(f"{phase}: peak RSS +{cur_rss} > +{base_rss} (+{threshold:.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark audio I/O (save_wav_file / merge_wav_files)")
+    parser.add_argument("--chunks", type=int, default=500, help="Số chunk WAV")
+    parser.add_argument("--chunk-seconds", type=float, default=8.0, help="Độ dài mỗi chunk (giây)")
+    parser.add_argument("--phases", default=",".join(PHASES))
+    parser.add_argument("--workdir", default=None, help="Thư mục làm việc (mặc định: thư mục tạm)")
+    parser.add_argument("--keep", action="store_true", help="Giữ lại file đã sinh")
+    parser.add_argument("--output", default=None, help="Ghi kết quả JSON (dùng làm baseline)")
+    parser.add_argument("--compare", default=None, help="Baseline JSON để so sánh")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Ngưỡng regression (0.2 = chậm hơn 20%%)")
+    parser.add_argument("--phase", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.phase:
+        return child_main(args)
+
+    phases = [p for p in args.phases.split(",") if p]
+    if "write" not in phases and args.workdir is None:
+        parser.error("Không có pha write thì cần --workdir chứa chunk đã sinh")
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bench_audio_")
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        results = run_all(args.chunks, args.chunk_seconds, workdir, phases)
+    finally:
+        if not args.keep and args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    total_seconds = args.chunks * args.chunk_seconds
+    report = {
+        "benchmark": "audio_io",
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "chunks": args.chunks,
+            "chunk_seconds": args.chunk_seconds,
+            "total_audio_hours": round(total_seconds / 3600, 3),
+            "total_pcm_bytes": int(total_seconds * SAMPLE_RATE) * SAMPLE_WIDTH * CHANNELS,
+            "sample_rate": SAMPLE_RATE,
+        },
+        "results": results,
+    }
+
+    regressions = []
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        report["regressions"] = regressions
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    print(output)
+
+    for line in regressions:
+        print(f"⚠️ {line}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
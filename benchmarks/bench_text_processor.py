@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+⏱️ BENCHMARK - EnhancedTextProcessor
+
+Đo clean_text, detect_language_enhanced, analyze_sentiment_and_style, _calculate_confidence và
+create_style_analysis_json trên corpus tiếng Việt / tiếng Nhật / hỗn hợp sinh tự động (seed cố định):
+✅ chars/giây, câu/giây (lấy lần chạy nhanh nhất trong --repeat)
+✅ Bộ nhớ đỉnh (tracemalloc) của create_style_analysis_json
+   (create_style_analysis_json luôn đo ở chế độ tuần tự - tracemalloc không thấy tiến trình con;
+   chế độ process pool được đo riêng thành create_style_analysis_json_parallel khi văn bản đủ dài)
+✅ Digest kết quả phân tích - tối ưu hóa phải giữ nguyên output
+✅ Ghi baseline JSON, so sánh với baseline (--compare) và báo regression
+
+Dùng:
+    python benchmarks/bench_text_processor.py --output baseline.json
+    python benchmarks/bench_text_processor.py --compare baseline.json --threshold 0.15
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tts  # noqa: E402
+
+DEFAULT_SIZES = [1_000, 10_000, 100_000, 500_000]
+CORPORA = ["vietnamese", "japanese", "mixed"]
+SEED = 20251101
+
+VI_WORDS = (
+    "tôi bạn chúng ta hôm nay ngày mai trời đẹp quá học tiếng Nhật rất vui và của trong với để có là "
+    "được những các này đó người Việt Nam thành phố Hà Nội Sài Gòn công việc gia đình hạnh phúc buồn "
+    "tuyệt vời thích yêu ghét sợ lo khó tốt hay xấu đau kính thưa xin phép trân trọng bài học hôm qua "
+    "mua sắm nhà hàng món ăn ngon thời tiết mùa xuân mùa hè cà phê sách vở giáo viên học sinh"
+).split()
+JA_WORDS = (
+    "私 あなた 今日 明日 天気 いい です ます だ である は が を に で と から 日本語 勉強 毎日 少し ずつ "
+    "続ける こと 大切 東京 大阪 友達 一緒 散歩 しましょう 食べ物 美味しい 先生 学生 本 読む 書く "
+    "「こんにちは」 （例） カタカナ ひらがな 漢字 コーヒー ラーメン ー 〜"
+).split()
+EMOJI = ["😀", "🎵", "🔥", "⭐", "📚"]
+VI_END = [".", "!", "?", "."]
+JA_END = ["。", "！", "？", "。"]
+
+
+def generate_sentence(rng, lang):
+    if lang == "japanese":
+        words = rng.choices(JA_WORDS, k=rng.randint(4, 14))
+        sentence = "".join(words) + rng.choice(JA_END)
+    else:
+        words = rng.choices(VI_WORDS, k=rng.randint(4, 18))
+        sentence = " ".join(words)
+        sentence = sentence[0].upper() + sentence[1:] + rng.choice(VI_END)
+    if rng.random() < 0.05:
+        sentence = rng.choice(EMOJI) + " " + sentence
+    return sentence
+
+
+def generate_corpus(kind, size, seed=SEED):
+    """Văn bản ~size ký tự, tất định theo (kind, size, seed)"""
+    rng = random.Random(f"{seed}:{kind}:{size}")
+    parts = []
+    length = 0
+    while length < size:
+        if kind == "mixed":
+            lang = "japanese" if rng.random() < 0.5 else "vietnamese"
+        else:
+            lang = kind
+        sentence = generate_sentence(rng, lang)
+        separator = "\n\n" if rng.random() < 0.1 else " "
+        parts.append(sentence + separator)
+        length += len(sentence) + len(separator)
+    return "".join(parts)[:size]
+
+
+def best_time(func, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_corpus(processor, text, repeat):
+    cleaned = processor.clean_text(text)
+    sentences = processor.sentence_split(cleaned)
+    sentence_chars = sum(len(s) for s in sentences)
+    languages = [processor.detect_language_enhanced(s) for s in sentences]
+
+    def run_detect():
+        for s in sentences:
+            processor.detect_language_enhanced(s)
+
+    def run_style():
+        for s in sentences:
+            processor.analyze_sentiment_and_style(s)
+
+    def run_confidence():
+        for s, lang in zip(sentences, languages):
+            processor._calculate_confidence(s, lang)
+
+    # Chế độ app sẽ chọn cho văn bản này (process pool từ PARALLEL_ANALYSIS_MIN_CHARS)
+    auto_mode = "parallel" if processor.parallel_analysis_enabled(len(cleaned)) else "serial"
+    
+    timings = {
+        "clean_text": (best_time(lambda: processor.clean_text(text), repeat), len(text)),
+        "detect_language_enhanced": (best_time(run_detect, repeat), sentence_chars),
+        "analyze_sentiment_and_style": (best_time(run_style, repeat), sentence_chars),
+        "_calculate_confidence": (best_time(run_confidence, repeat), sentence_chars),
+        "create_style_analysis_json": (
+            best_time(lambda: processor.create_style_analysis_json(text, parallel=False), repeat), len(text)
+        ),
+    }
+    if auto_mode == "parallel":
+        processor.create_style_analysis_json(text, parallel=True)  # khởi động pool, không tính vào thời gian
+        timings["create_style_analysis_json_parallel"] = (
+            best_time(lambda: processor.create_style_analysis_json(text, parallel=True), repeat), len(text)
+        )
+
+    results = {}
+    for name, (seconds, chars) in timings.items():
+        results[name] = {
+            "seconds": round(seconds, 6),
+            "chars_per_sec": round(chars / seconds, 1) if seconds > 0 else None,
+            "sentences_per_sec": round(len(sentences) / seconds, 1) if seconds > 0 else None,
+        }
+
+    tracemalloc.start()
+    analysis = processor.create_style_analysis_json(text, parallel=False)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    digest = hashlib.sha256(
+        json.dumps(analysis, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+    return {
+        "chars": len(text),
+        "sentences": len(sentences),
+        "functions": results,
+        "peak_memory_bytes": peak,
+        "analysis_digest": digest,
+        "analysis_mode": "serial",
+        "auto_mode": auto_mode,
+    }
+
+
+def run(sizes, corpora, repeat):
+    processor = tts.EnhancedTextProcessor()
+    report = {
+        "benchmark": "text_processor",
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": repeat,
+        "seed": SEED,
+        "numpy": tts.NUMPY_AVAILABLE,
+        "analysis_workers": tts.ANALYSIS_WORKERS,
+        "parallel_min_chars": tts.PARALLEL_ANALYSIS_MIN_CHARS,
+        "results": {},
+    }
+    for kind in corpora:
+        for size in sizes:
+            name = f"{kind}_{size}"
+            print(f"⏱️ {name}...", file=sys.stderr)
+            report["results"][name] = bench_corpus(processor, generate_corpus(kind, size), repeat)
+    tts.shutdown_analysis_pool()
+    return report
+
+
+def compare(report, baseline, threshold):
+    """Liệt kê regression (chậm hơn / tốn bộ nhớ hơn threshold) và output thay đổi"""
+    regressions = []
+    for name, current in report["results"].items():
+        base = baseline.get("results", {}).get(name)
+        if not base:
+            continue
+        if base.get("analysis_digest") != current["analysis_digest"]:
+            regressions.append(f"{name}: output create_style_analysis_json khác baseline")
+        for func, stats in current["functions"].items():
+            base_stats = base["functions"].get(func)
+            if not base_stats or not base_stats.get("chars_per_sec") or not stats.get("chars_per_sec"):
+                continue
+            ratio = stats["chars_per_sec"] / base_stats["chars_per_sec"]
+            stats["vs_baseline"] = round(ratio, 3)
+            if ratio < 1 - threshold:
+                regressions.append(f"{name}/{func}: {ratio:.2f}x baseline")
+        base_peak = base.get("peak_memory_bytes")
+        if base_peak and current["peak_memory_bytes"] > base_peak * (1 + threshold):
+            regressions.append(
+                f"{name}: peak memory {current['peak_memory_bytes']} > {base_peak} (+{threshold:.0%})"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark EnhancedTextProcessor")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="Kích thước corpus (ký tự)")
+    parser.add_argument("--corpora", default=",".join(CORPORA), help="vietnamese,japanese,mixed")
+    parser.add_argument("--repeat", type=int, default=3, help="Số lần chạy mỗi phép đo (lấy nhanh nhất)")
+    parser.add_argument("--output", default=None, help="Ghi kết quả JSON (dùng làm baseline)")
+    parser.add_argument("--compare", default=None, help="Baseline JSON để so sánh")
+    parser.add_argument("--threshold", type=float, default=0.15, help="Ngưỡng regression (0.15 = chậm hơn 15%%)")
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+    corpora = [c for c in args.corpora.split(",") if c]
+    report = run(sizes, corpora, args.repeat)
+
+    regressions = []
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        report["regressions"] = regressions
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    print(output)
+
+    for line in regressions:
+        print(f"⚠️ {line}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+📈 LOAD TEST - Đo throughput của GeminiAPIManager (key pool + scheduler) với mock server
+
+Chạy call_gemini_text_api / call_gemini_tts_api ở mức song song cấu hình được, in kết quả JSON:
+✅ requests/giây, latency p50/p95/p99
+✅ Tỉ lệ 429 (HTTP) và tỉ lệ request thất bại
+✅ Mức sử dụng từng key
+✅ Kiểm tra nhất quán bộ đếm (manager nội bộ, phía harness, phía server)
+
+Dùng:
+    python benchmarks/load_test.py --keys 8 --concurrency 16 --requests 500 --latency lognormal:-2.5,0.5 --error-429 0.05
+    python benchmarks/load_test.py --server http://127.0.0.1:8765 --mode mixed --duration 30 --output run.json
+    python benchmarks/load_test.py ... --compare baseline.json
+
+Mặc định tự chạy benchmarks/mock_gemini_server.py trong tiến trình; manager chạy với persist=False nên không
+đụng tới key/state đã lưu của người dùng.
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tts  # noqa: E402
+from mock_gemini_server import MockGeminiConfig, MockGeminiServer  # noqa: E402
+
+SAMPLE_TEXTS = [
+    "Xin chào các bạn, hôm nay chúng ta sẽ học cách phát âm tiếng Nhật cơ bản.",
+    "こんにちは。今日はいい天気ですね。一緒に散歩しましょう。",
+    "Trong bài này, tôi sẽ giới thiệu những mẫu câu thường dùng khi đi mua sắm.",
+    "日本語の勉強は毎日少しずつ続けることが大切です。",
+]
+REWRITE_PROMPT = "Viết lại đoạn văn sau cho tự nhiên hơn, giữ nguyên ý nghĩa."
+
+
+def percentile(sorted_values, p):
+    """Percentile kiểu nearest-rank trên danh sách đã sắp xếp"""
+    if not sorted_values:
+        return None
+    rank = max(1, int(round(p / 100.0 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def make_keys(count):
+    # add_api_key yêu cầu key >= 20 ký tự
+    return [f"mock-load-test-key-{i:04d}" for i in range(count)]
+
+
+def snapshot_usage(manager):
+    """Bộ đếm theo key qua get_usage_stats(), theo đuôi key (8 ký tự cuối)"""
+    return {entry["suffix"]: entry for entry in manager.get_usage_stats()["keys"]}
+
+
+def fetch_server_stats(url):
+    try:
+        with urllib.request.urlopen(f"{url}/__stats", timeout=5) as response:
+            return json.loads(response.read().decode("utf-8"))
+    except Exception:
+        return None
+
+
+def run_load(manager, mode, concurrency, total_requests=None, duration=None, text_model=None):
+    """Chạy tải, trả về danh sách kết quả từng request"""
+    counter = itertools.count()
+    deadline = time.time() + duration if duration else None
+    results = []
+    results_lock = threading.Lock()
+
+    def one_request(i):
+        text = SAMPLE_TEXTS[i % len(SAMPLE_TEXTS)]
+        kind = mode if mode != "mixed" else ("tts" if i % 2 else "text")
+        start = time.perf_counter()
+        if kind == "tts":
+            result = manager.call_gemini_tts_api(text, "Kore")
+        else:
+            result = manager.call_gemini_text_api(
+                f"{REWRITE_PROMPT}\n\nVăn bản:\n{text}", text_model
+            )
+        latency = time.perf_counter() - start
+        return {
+            "kind": kind,
+            "latency": latency,
+            "success": bool(result.get("success")),
+            "rate_limited": bool(result.get("rate_limited")),
+            "error": None if result.get("success") else str(result.get("error"))[:120],
+        }
+
+    def worker():
+        while True:
+            i = next(counter)
+            if total_requests is not None and i >= total_requests:
+                return
+            if deadline is not None and time.time() >= deadline:
+                return
+            record = one_request(i)
+            with results_lock:
+                results.append(record)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(worker) for _ in range(concurrency)]:
+            future.result()
+    return results
+
+
+def summarize(results, elapsed, usage_before, usage_after, server_before, server_after):
+    latencies = sorted(r["latency"] for r in results)
+    succeeded = sum(1 for r in results if r["success"])
+
+    suffixes = list(usage_after)
+    per_key = {}
+    http_calls = http_429 = http_ok = 0
+    for suffix in suffixes:
+        before = usage_before.get(suffix, {})
+        after = usage_after[suffix]
+        # get_usage_stats gọi số thành công là "success"
+        delta = {field: after.get(source, 0) - before.get(source, 0)
+                 for field, source in (("calls", "calls"), ("successful_calls", "success"),
+                                       ("errors", "errors"), ("rate_limits", "rate_limits"))}
+        per_key[f"...{suffix}"] = delta
+        http_calls += delta["calls"]
+        http_ok += delta["successful_calls"]
+        http_429 += delta["rate_limits"]
+
+    shares = [d["successful_calls"] / http_ok for d in per_key.values()] if http_ok else []
+    for fingerprint, share in zip(per_key, shares):
+        per_key[fingerprint]["share"] = round(share, 4)
+
+    errors = {}
+    for r in results:
+        if not r["success"]:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+
+    # Nhất quán bộ đếm: manager nội bộ, harness, server
+    checks = {
+        "calls_equals_success_plus_errors": all(
+            d["calls"] == d["successful_calls"] + d["errors"] for d in per_key.values()
+        ),
+        "rate_limits_within_errors": all(d["rate_limits"] <= d["errors"] for d in per_key.values()),
+        "harness_success_equals_manager_success": succeeded == http_ok,
+    }
+    if server_before is not None and server_after is not None:
+        server_ok = server_429 = 0
+        for key in set(server_before) | set(server_after):
+            if key[-8:] not in usage_after:
+                continue  # Key không thuộc lần chạy này (server dùng chung)
+            before = server_before.get(key, {})
+            after = server_after.get(key, {})
+            server_ok += after.get("200", 0) - before.get("200", 0)
+            server_429 += after.get("429", 0) - before.get("429", 0)
+        checks["server_200_equals_manager_success"] = server_ok == http_ok
+        checks["server_429_equals_manager_rate_limits"] = server_429 == http_429
+
+    return {
+        "requests": len(results),
+        "succeeded": succeeded,
+        "failed": len(results) - succeeded,
+        "elapsed_s": round(elapsed, 3),
+        "rps": round(len(results) / elapsed, 2) if elapsed > 0 else None,
+        "success_rps": round(succeeded / elapsed, 2) if elapsed > 0 else None,
+        "latency_s": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": latencies[-1] if latencies else None,
+        },
+        "http_calls": http_calls,
+        "http_429": http_429,
+        "rate_429": round(http_429 / http_calls, 4) if http_calls else 0.0,
+        "failure_rate": round((len(results) - succeeded) / len(results), 4) if results else 0.0,
+        "key_utilization": {
+            "keys": len(suffixes),
+            "min_share": round(min(shares), 4) if shares else None,
+            "max_share": round(max(shares), 4) if shares else None,
+            "per_key": per_key,
+        },
+        "errors": errors,
+        "counter_consistency": checks,
+    }
+
+
+def compare(current, baseline):
+    """Chênh lệch các chỉ số chính so với lần chạy trước"""
+    def delta(a, b):
+        if a is None or b is None:
+            return None
+        return {"current": a, "baseline": b, "change_pct": round((a - b) / b * 100, 1) if b else None}
+
+    return {
+        "rps": delta(current["rps"], baseline.get("rps")),
+        "p50": delta(current["latency_s"]["p50"], baseline.get("latency_s", {}).get("p50")),
+        "p95": delta(current["latency_s"]["p95"], baseline.get("latency_s", {}).get("p95")),
+        "p99": delta(current["latency_s"]["p99"], baseline.get("latency_s", {}).get("p99")),
+        "rate_429": delta(current["rate_429"], baseline.get("rate_429")),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test key pool / scheduler của GeminiAPIManager")
+    parser.add_argument("--mode", choices=["text", "tts", "mixed"], default="text")
+    parser.add_argument("--keys", type=int, default=4, help="Số API key giả")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200, help="Tổng số request (bỏ qua nếu có --duration)")
+    parser.add_argument("--duration", type=float, default=None, help="Chạy trong N giây")
+    parser.add_argument("--text-model", default=None, help="Model text (mặc định: model mặc định của manager)")
+    parser.add_argument("--rpm", type=float, default=None,
+                        help="Ghi đè RPM mỗi key cho model đang test (0 = không pacing phía client)")
+    parser.add_argument("--rpd", type=int, default=None, help="Ghi đè RPD mỗi key (0 = không giới hạn)")
+    parser.add_argument("--max-key-wait", type=float, default=None, help="Số giây tối đa chờ key rảnh")
+    parser.add_argument("--server", default=None, help="URL mock server có sẵn (mặc định: tự chạy trong tiến trình)")
+    parser.add_argument("--latency", default="lognormal:-3,0.5", help="Phân phối độ trễ của mock server")
+    parser.add_argument("--error-429", type=float, default=0.0)
+    parser.add_argument("--error-5xx", type=float, default=0.0)
+    parser.add_argument("--key-rpm", type=int, default=0, help="Quota RPM mỗi key phía mock server")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--label", default=None, help="Nhãn cho lần chạy (ghi vào JSON)")
+    parser.add_argument("--output", default=None, help="Ghi kết quả JSON ra file")
+    parser.add_argument("--compare", default=None, help="File JSON của lần chạy trước để so sánh")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR)
+
+    server = None
+    url = args.server
+    if url is None:
+        server = MockGeminiServer(config=MockGeminiConfig(
+            latency=args.latency,
+            error_429=args.error_429,
+            error_5xx=args.error_5xx,
+            key_rpm=args.key_rpm,
+            seed=args.seed,
+        )).start()
+        url = server.url
+
+    manager = tts.GeminiAPIManager(base_url=url, persist=False,
+                                   http_pool_size=max(tts.DEFAULT_HTTP_POOL_SIZE, args.concurrency))
+    for key in make_keys(args.keys):
+        manager.add_api_key(key)
+
+    models = [args.text_model or manager.default_model, manager.tts_model]
+    for model in models:
+        if args.rpm is not None or args.rpd is not None:
+            manager.set_model_rate_limit(model, rpm=args.rpm, rpd=args.rpd)
+    if args.max_key_wait is not None:
+        manager.max_key_wait = args.max_key_wait
+
+    # Khởi động: models.list + mở kết nối trước khi đo
+    manager.refresh_model_availability(force=True)
+
+    usage_before = snapshot_usage(manager)
+    server_before = fetch_server_stats(url)
+    started = time.perf_counter()
+    try:
+        results = run_load(manager, args.mode, args.concurrency,
+                           None if args.duration else args.requests, args.duration, args.text_model)
+    finally:
+        elapsed = time.perf_counter() - started
+        usage_after = snapshot_usage(manager)
+        server_after = fetch_server_stats(url)
+        manager.close()
+        if server is not None:
+            server.stop()
+
+    report = {
+        "label": args.label,
+        "config": {
+            "mode": args.mode,
+            "keys": args.keys,
+            "concurrency": args.concurrency,
+            "requests": None if args.duration else args.requests,
+            "duration": args.duration,
+            "rpm": args.rpm,
+            "rpd": args.rpd,
+            "server": args.server or "in-process",
+            "latency": args.latency if server is not None else None,
+            "error_429": args.error_429 if server is not None else None,
+            "error_5xx": args.error_5xx if server is not None else None,
+            "key_rpm": args.key_rpm if server is not None else None,
+        },
+    }
+    report.update(summarize(results, elapsed, usage_before, usage_after, server_before, server_after))
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            report["compare"] = compare(report, json.load(f))
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    print(output)
+    return 0 if all(report["counter_consistency"].values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+🧪 MOCK GEMINI SERVER - Chạy pipeline TTS/viết lại không cần API key thật
+
+Giả lập các endpoint v1beta mà tts.py dùng:
+✅ GET  /v1beta/models                              (models.list)
+✅ POST /v1beta/models/{model}:generateContent       (text + audio PCM tổng hợp)
+✅ POST /v1beta/models/{model}:streamGenerateContent (SSE, ?alt=sse)
+✅ Độ trễ theo phân phối, lỗi 429/404/5xx ngẫu nhiên, quota theo key (RPM/RPD)
+
+Dùng:
+    python benchmarks/mock_gemini_server.py --port 8765 --latency lognormal:-2.5,0.5 --error-429 0.05
+    BILINGUAL_TTS_API_ROOT=http://127.0.0.1:8765 python tts.py
+
+Key lấy từ ?key=... hoặc header x-goog-api-key (google-genai). GET /__stats trả về số request
+server đã thấy theo key/mã trạng thái để đối chiếu với thống kê phía client.
+"""
+
+import argparse
+import base64
+import json
+import math
+import random
+import re
+import threading
+import time
+from array import array
+from collections import defaultdict, deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+DEFAULT_MODELS = [
+    "gemini-1.5-flash",
+    "gemini-2.0-flash",
+    "gemini-2.0-flash-exp",
+    "gemini-2.0-flash-lite",
+    "gemini-2.5-flash",
+    "gemini-2.5-flash-lite",
+    "gemini-2.5-pro",
+    "gemini-flash-latest",
+    "gemini-2.5-flash-preview-tts",
+    "gemini-2.5-pro-preview-tts",
+]
+
+SAMPLE_RATE = 24000
+AUDIO_SECONDS_PER_CHAR = 0.06
+STREAM_TEXT_PIECES = 8
+STREAM_AUDIO_CHUNK_SECONDS = 0.5
+
+_MODEL_ACTION_REGEX = re.compile(r'^/v1beta/models/([^/:]+):(generateContent|streamGenerateContent)$')
+_MODEL_REGEX = re.compile(r'^/v1beta/models/([^/:]+)$')
+
+
+# =====================================
+# LATENCY
+# =====================================
+
+class LatencyModel:
+    """Độ trễ (giây) theo phân phối: const:x | uniform:a,b | normal:mean,std | lognormal:mu,sigma | exp:mean"""
+
+    def __init__(self, spec: str = "const:0"):
+        self.spec = spec
+        kind, _, args = spec.partition(":")
+        self.kind = kind.strip().lower()
+        self.args = [float(a) for a in args.split(",") if a.strip()]
+        expected = {"const": 1, "uniform": 2, "normal": 2, "lognormal": 2, "exp": 1}
+        if self.kind not in expected or len(self.args) != expected[self.kind]:
+            raise ValueError(f"Latency không hợp lệ: {spec}")
+
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == "const":
+            value = self.args[0]
+        elif self.kind == "uniform":
+            value = rng.uniform(*self.args)
+        elif self.kind == "normal":
+            value = rng.gauss(*self.args)
+        elif self.kind == "lognormal":
+            value = rng.lognormvariate(*self.args)
+        else:
+            value = rng.expovariate(1.0 / self.args[0]) if self.args[0] > 0 else 0.0
+        return max(0.0, value)
+
+
+# =====================================
+# QUOTA
+# =====================================
+
+class KeyQuota:
+    """Quota theo key: RPM (cửa sổ trượt 60s) và RPD (reset khi server khởi động lại / reset_daily)"""
+
+    def __init__(self, rpm: int = 0, rpd: int = 0):
+        self.rpm = rpm
+        self.rpd = rpd
+        self.lock = threading.Lock()
+        self.minute_calls = defaultdict(deque)
+        self.daily_calls = defaultdict(int)
+
+    def check(self, key: str, now: float):
+        """None nếu còn quota, ngược lại ("minute"|"day", retry_after)"""
+        with self.lock:
+            if self.rpd and self.daily_calls[key] >= self.rpd:
+                return "day", 3600.0
+            calls = self.minute_calls[key]
+            while calls and now - calls[0] >= 60:
+                calls.popleft()
+            if self.rpm and len(calls) >= self.rpm:
+                return "minute", max(1.0, 60 - (now - calls[0]))
+            calls.append(now)
+            self.daily_calls[key] += 1
+            return None
+
+    def reset_daily(self):
+        with self.lock:
+            self.daily_calls.clear()
+
+
+# =====================================
+# SYNTHETIC CONTENT
+# =====================================
+
+def synth_pcm(text: str, sample_rate: int = SAMPLE_RATE, seconds_per_char: float = AUDIO_SECONDS_PER_CHAR) -> bytes:
+    """PCM 16-bit mono: sóng sin, độ dài tỉ lệ với số ký tự"""
+    seconds = max(0.2, len(text) * seconds_per_char)
+    n = int(seconds * sample_rate)
+    freq = 180 + (sum(map(ord, text[:32])) % 200)
+    step = 2 * math.pi * freq / sample_rate
+    samples = array('h', (int(8000 * math.sin(i * step)) for i in range(n)))
+    return samples.tobytes()
+
+
+def synth_text(prompt: str) -> str:
+    """'Viết lại' = trả lại văn bản sau 'Văn bản:' (giữ nguyên nội dung để kiểm tra ghép/thứ tự)"""
+    marker = "Văn bản:\n"
+    if marker in prompt:
+        return prompt.split(marker, 1)[1]
+    return prompt
+
+
+def split_pieces(data, count: int):
+    if count <= 1 or len(data) <= 1:
+        return [data]
+    size = max(1, math.ceil(len(data) / count))
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+# =====================================
+# SERVER
+# =====================================
+
+class MockGeminiConfig:
+    def __init__(self, latency="const:0", stream_interval="const:0", error_429=0.0, error_404=0.0,
+                 error_5xx=0.0, key_rpm=0, key_rpd=0, models=None, missing_models=None,
+                 audio_seconds_per_char=AUDIO_SECONDS_PER_CHAR, sample_rate=SAMPLE_RATE, seed=None):
+        self.latency = LatencyModel(latency)
+        self.stream_interval = LatencyModel(stream_interval)
+        self.error_429 = error_429
+        self.error_404 = error_404
+        self.error_5xx = error_5xx
+        self.quota = KeyQuota(key_rpm, key_rpd)
+        self.models = list(models or DEFAULT_MODELS)
+        self.missing_models = set(missing_models or [])
+        self.audio_seconds_per_char = audio_seconds_per_char
+        self.sample_rate = sample_rate
+        self.seed = seed
+
+
+class MockGeminiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "MockGemini/1.0"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    # ---------- helpers ----------
+
+    def _api_key(self, query):
+        return (query.get("key") or [None])[0] or self.headers.get("x-goog-api-key")
+
+    def _send_json(self, status: int, body: dict, headers: dict = None):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self, status: int, grpc_status: str, message: str, details=None, headers=None):
+        error = {"code": status, "message": message, "status": grpc_status}
+        if details:
+            error["details"] = details
+        self._send_json(status, {"error": error}, headers)
+
+    def _send_429(self, retry_after: float, scope: str):
+        quota_id = ("GenerateRequestsPerDayPerProjectPerModel-FreeTier" if scope == "day"
+                    else "GenerateRequestsPerMinutePerProjectPerModel-FreeTier")
+        self._send_error(
+            429, "RESOURCE_EXHAUSTED",
+            "You exceeded your current quota, please check your plan and billing details.",
+            details=[
+                {"@type": "type.googleapis.com/google.rpc.QuotaFailure",
+                 "violations": [{"quotaId": quota_id}]},
+                {"@type": "type.googleapis.com/google.rpc.RetryInfo",
+                 "retryDelay": f"{int(math.ceil(retry_after))}s"},
+            ],
+            headers={"Retry-After": str(int(math.ceil(retry_after)))},
+        )
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        return json.loads(raw.decode("utf-8")) if raw else {}
+
+    # ---------- routes ----------
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        config = self.server.config
+
+        if url.path == "/__stats":
+            self._send_json(200, self.server.snapshot_stats())
+            return
+
+        key = self._api_key(query)
+        if not key:
+            self._send_error(403, "PERMISSION_DENIED", "Method doesn't allow unregistered callers.")
+            return
+
+        if url.path == "/v1beta/models":
+            models = [
+                {
+                    "name": f"models/{name}",
+                    "displayName": name,
+                    "supportedGenerationMethods": ["generateContent", "streamGenerateContent", "countTokens"],
+                }
+                for name in config.models if name not in config.missing_models
+            ]
+            self._send_json(200, {"models": models})
+            return
+
+        match = _MODEL_REGEX.match(url.path)
+        if match and match.group(1) in config.models and match.group(1) not in config.missing_models:
+            self._send_json(200, {"name": f"models/{match.group(1)}", "displayName": match.group(1)})
+            return
+
+        self._send_error(404, "NOT_FOUND", f"{url.path} not found")
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        config = self.server.config
+        rng = self.server.rng()
+
+        match = _MODEL_ACTION_REGEX.match(url.path)
+        if not match:
+            self._send_error(404, "NOT_FOUND", f"{url.path} not found")
+            return
+        model, action = match.groups()
+        stream = action == "streamGenerateContent"
+
+        try:
+            body = self._read_json()
+        except Exception:
+            self._send_error(400, "INVALID_ARGUMENT", "Invalid JSON payload")
+            return
+
+        key = self._api_key(query)
+        if not key:
+            self._send_error(403, "PERMISSION_DENIED", "Method doesn't allow unregistered callers.")
+            return
+
+        time.sleep(config.latency.sample(rng))
+
+        if model not in config.models or model in config.missing_models or rng.random() < config.error_404:
+            self.server.record(key, model, 404)
+            self._send_error(404, "NOT_FOUND",
+                             f"models/{model} is not found for API version v1beta, or is not supported for {action}.")
+            return
+
+        limited = config.quota.check(key, time.time())
+        if limited is None and rng.random() < config.error_429:
+            limited = ("minute", 1.0 + rng.random() * 4)
+        if limited is not None:
+            self.server.record(key, model, 429)
+            self._send_429(limited[1], limited[0])
+            return
+
+        if rng.random() < config.error_5xx:
+            status = rng.choice([500, 503])
+            self.server.record(key, model, status)
+            self._send_error(status, "UNAVAILABLE" if status == 503 else "INTERNAL",
+                             "The model is overloaded. Please try again later.")
+            return
+
+        prompt = "".join(
+            part.get("text", "")
+            for content in body.get("contents", [])
+            for part in content.get("parts", [])
+        )
+        generation_config = body.get("generationConfig") or {}
+        modalities = [m.upper() for m in generation_config.get("responseModalities") or []]
+        audio = "AUDIO" in modalities or "tts" in model
+
+        if audio:
+            pcm = synth_pcm(prompt, config.sample_rate, config.audio_seconds_per_char)
+            frame_bytes = max(2, int(STREAM_AUDIO_CHUNK_SECONDS * config.sample_rate) * 2)
+            pieces = [pcm[i:i + frame_bytes] for i in range(0, len(pcm), frame_bytes)] if stream else [pcm]
+            make_part = lambda piece: {"inlineData": {
+                "mimeType": f"audio/L16;codec=pcm;rate={config.sample_rate}",
+                "data": base64.b64encode(piece).decode("ascii"),
+            }}
+        else:
+            text = synth_text(prompt)
+            max_chars = int(generation_config.get("maxOutputTokens") or 0) * 4
+            finish_reason = "STOP"
+            if max_chars and len(text) > max_chars:
+                text, finish_reason = text[:max_chars], "MAX_TOKENS"
+            pieces = split_pieces(text, STREAM_TEXT_PIECES) if stream else [text]
+            make_part = lambda piece: {"text": piece}
+
+        usage = {"promptTokenCount": max(1, len(prompt) // 4)}
+
+        def response_for(piece, last):
+            candidate = {"content": {"role": "model", "parts": [make_part(piece)]}, "index": 0}
+            if last:
+                candidate["finishReason"] = "STOP" if audio else finish_reason
+            return {"candidates": [candidate], "usageMetadata": usage, "modelVersion": model}
+
+        self.server.record(key, model, 200)
+
+        if not stream:
+            self._send_json(200, response_for(pieces[0], True))
+            return
+
+        # SSE: mỗi phần là 1 event "data: {...}"
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        try:
+            for i, piece in enumerate(pieces):
+                if i:
+                    time.sleep(config.stream_interval.sample(rng))
+                event = json.dumps(response_for(piece, i == len(pieces) - 1), ensure_ascii=False)
+                self.wfile.write(f"data: {event}\r\n\r\n".encode("utf-8"))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+class MockGeminiServer(ThreadingHTTPServer):
+    """Server chạy trong thread nền - dùng được trực tiếp từ script benchmark/test"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0, config: MockGeminiConfig = None, verbose=False):
+        super().__init__((host, port), MockGeminiHandler)
+        self.config = config or MockGeminiConfig()
+        self.verbose = verbose
+        self._stats_lock = threading.Lock()
+        self._stats = defaultdict(lambda: defaultdict(int))
+        self._rng_seed = _seed_sequence(self.config.seed)
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def rng(self) -> random.Random:
+        # Mỗi request 1 Random riêng (random.Random không chia sẻ an toàn giữa các thread)
+        return random.Random(next(self._rng_seed))
+
+    def record(self, key: str, model: str, status: int):
+        with self._stats_lock:
+            self._stats[key][str(status)] += 1
+            self._stats[key][f"{model}:{status}"] += 1
+
+    def snapshot_stats(self) -> dict:
+        with self._stats_lock:
+            return {key: dict(counts) for key, counts in self._stats.items()}
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+
+def _seed_sequence(seed):
+    """Chuỗi seed cho từng request: tất định nếu có seed, ngẫu nhiên nếu không"""
+    lock = threading.Lock()
+    counter = [0]
+    base = seed if seed is not None else random.randrange(1 << 30)
+
+    def gen():
+        while True:
+            with lock:
+                counter[0] += 1
+                value = counter[0]
+            yield base * 1_000_003 + value
+    return gen()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock Gemini API server cho benchmark/test offline")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", default="const:0",
+                        help="Độ trễ mỗi request: const:x | uniform:a,b | normal:m,s | lognormal:mu,sigma | exp:mean")
+    parser.add_argument("--stream-interval", default="const:0", help="Độ trễ giữa các event SSE")
+    parser.add_argument("--error-429", type=float, default=0.0, help="Xác suất trả 429")
+    parser.add_argument("--error-404", type=float, default=0.0, help="Xác suất trả 404")
+    parser.add_argument("--error-5xx", type=float, default=0.0, help="Xác suất trả 500/503")
+    parser.add_argument("--key-rpm", type=int, default=0, help="Quota request/phút mỗi key (0 = không giới hạn)")
+    parser.add_argument("--key-rpd", type=int, default=0, help="Quota request/ngày mỗi key (0 = không giới hạn)")
+    parser.add_argument("--models", default=",".join(DEFAULT_MODELS), help="Danh sách model có sẵn")
+    parser.add_argument("--missing-models", default="", help="Model luôn trả 404")
+    parser.add_argument("--audio-seconds-per-char", type=float, default=AUDIO_SECONDS_PER_CHAR)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    config = MockGeminiConfig(
+        latency=args.latency,
+        stream_interval=args.stream_interval,
+        error_429=args.error_429,
+        error_404=args.error_404,
+        error_5xx=args.error_5xx,
+        key_rpm=args.key_rpm,
+        key_rpd=args.key_rpd,
+        models=[m for m in args.models.split(",") if m],
+        missing_models=[m for m in args.missing_models.split(",") if m],
+        audio_seconds_per_char=args.audio_seconds_per_char,
+        seed=args.seed,
+    )
+    server = MockGeminiServer(args.host, args.port, config, verbose=args.verbose)
+    print(f"🧪 Mock Gemini server: {server.url}")
+    print(f"   BILINGUAL_TTS_API_ROOT={server.url} python tts.py")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n👋 Dừng server")
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
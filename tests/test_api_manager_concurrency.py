@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+🧪 STRESS TEST - Bộ đếm usage của GeminiAPIManager khi nhiều thread gọi đồng thời
+
+40 thread x 200 lần call_gemini_text_api qua requests.Session giả (trả 200/429/500 xen kẽ),
+sau đó so usage_stats (theo key, theo model, tổng) và get_usage_stats() với số response
+phía transport đã trả - phải khớp tuyệt đối.
+
+Dùng:
+    python -m unittest tests.test_api_manager_concurrency
+    python tests/test_api_manager_concurrency.py
+"""
+
+import json
+import os
+import re
+import sys
+import threading
+import unittest
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tts  # noqa: E402
+
+THREADS = 40
+CALLS_PER_THREAD = 200
+KEYS = 8
+URL_REGEX = re.compile(r'/models/([^:/]+):generateContent$')
+
+
+class StubResponse:
+    def __init__(self, status_code, body, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self._body = body
+        self.text = json.dumps(body)
+    
+    def json(self):
+        return self._body
+
+
+class StubSession:
+    """requests.Session giả: request thứ i trả 429 nếu i % 10 == 0, 500 nếu i % 10 == 1, còn lại 200"""
+    
+    def __init__(self, models):
+        self.models = models
+        self.lock = threading.Lock()
+        self.counter = 0
+        self.served = defaultdict(lambda: defaultdict(int))  # (key, model) -> status -> số lần
+    
+    def get(self, url, params=None, timeout=None):
+        return StubResponse(200, {"models": [
+            {"name": f"models/{m}", "supportedGenerationMethods": ["generateContent"]} for m in self.models
+        ]})
+    
+    def post(self, url, json=None, headers=None, timeout=None, stream=False):
+        model = URL_REGEX.search(url).group(1)
+        api_key = headers["x-goog-api-key"]
+        with self.lock:
+            i = self.counter
+            self.counter += 1
+            status = 429 if i % 10 == 0 else 500 if i % 10 == 1 else 200
+            self.served[(api_key, model)][status] += 1
+        
+        if status == 429:
+            return StubResponse(429, {"error": {"code": 429, "message": "Resource exhausted"}},
+                                {"Retry-After": "0"})
+        if status == 500:
+            return StubResponse(500, {"error": {"code": 500, "message": "Internal"}})
+        return StubResponse(200, {"candidates": [{"content": {"parts": [{"text": f"Kết quả giả số {i}"}]}}]})
+    
+    def close(self):
+        pass
+
+
+class APIManagerConcurrencyTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.manager = tts.GeminiAPIManager(persist=False)
+        for i in range(KEYS):
+            self.assertTrue(self.manager.add_api_key(f"stress-test-api-key-{i:04d}"))
+        self.model = self.manager.default_model
+        # Không pacing phía client, để mọi thread tranh nhau scheduler/limiter
+        self.manager.set_model_rate_limit(self.model, rpm=0, rpd=0)
+        self.session = StubSession([self.model])
+        self.manager._http_session = self.session
+    
+    def tearDown(self):
+        self.manager.close()
+    
+    def test_usage_counters_exact_under_concurrency(self):
+        results = defaultdict(int)
+        results_lock = threading.Lock()
+        
+        def worker(thread_index):
+            for n in range(CALLS_PER_THREAD):
+                result = self.manager.call_gemini_text_api(f"Câu {thread_index}-{n}", self.model)
+                with results_lock:
+                    results["success" if result.get("success") else "failed"] += 1
+        
+        with ThreadPoolExecutor(max_workers=THREADS) as executor:
+            for future in [executor.submit(worker, t) for t in range(THREADS)]:
+                future.result()
+        
+        self.assertEqual(results["success"] + results["failed"], THREADS * CALLS_PER_THREAD)
+        
+        served = self.session.served
+        totals = defaultdict(int)
+        for key in self.manager.api_keys:
+            counts = served.get((key, self.model), {})
+            expected = {
+                "calls": sum(counts.values()),
+                "successful_calls": counts.get(200, 0),
+                "errors": counts.get(429, 0) + counts.get(500, 0),
+                "rate_limits": counts.get(429, 0),
+            }
+            key_stats = self.manager.usage_stats[key]
+            model_stats = key_stats["models"].get(self.model, {})
+            for field, value in expected.items():
+                self.assertEqual(key_stats[field], value, f"{field} của key ...{key[-8:]}")
+                self.assertEqual(model_stats.get(field, 0), value, f"{field} của key ...{key[-8:]} / {self.model}")
+                totals[field] += value
+            # Quota ngày chỉ tính request server đã nhận (200), không tính 429/500
+            self.assertEqual(model_stats.get("daily_calls", 0), expected["successful_calls"])
+        
+        # Transport không nhận request nào ngoài model đang test
+        self.assertEqual(sum(sum(c.values()) for c in served.values()), self.session.counter)
+        self.assertEqual(totals["calls"], self.session.counter)
+        # Mỗi lệnh gọi thành công đúng 1 response 200
+        self.assertEqual(totals["successful_calls"], results["success"])
+        
+        stats = self.manager.get_usage_stats(self.model)
+        self.assertEqual(stats["total_calls"], totals["calls"])
+        self.assertEqual(stats["successful_calls"], totals["successful_calls"])
+        self.assertEqual(stats["total_errors"], totals["errors"])
+        self.assertEqual(stats["total_rate_limits"], totals["rate_limits"])
+        for entry in stats["keys"]:
+            key = next(k for k in self.manager.api_keys if k[-8:] == entry["suffix"])
+            counts = served.get((key, self.model), {})
+            self.assertEqual(entry["calls"], sum(counts.values()))
+            self.assertEqual(entry["success"], counts.get(200, 0))
+            self.assertEqual(entry["rate_limits"], counts.get(429, 0))
+            self.assertEqual(entry["models"][self.model]["calls"], sum(counts.values()))
+        
+        # Không key nào bị mất khỏi scheduler
+        self.assertEqual(len(self.manager.get_scheduler(self.model)), KEYS)
+
+
+if __name__ == "__main__":
+    unittest.main()
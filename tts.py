@@ -27,10 +27,19 @@ import threading
 import pickle
 import unicodedata
 import subprocess
+import shutil
+import tempfile
 from pathlib import Path
 from typing import List, Dict, Tuple, Optional
 import hashlib
 import random
+import math
+import heapq
+import copy
+import itertools
+import difflib
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, as_completed, FIRST_COMPLETED
 
 # Try to import cryptography for encryption
 try:
@@ -39,7 +48,23 @@ try:
 except ImportError:
     ENCRYPTION_AVAILABLE = False
 
+# Try to import google-genai for TTS
+try:
+    from google import genai
+    from google.genai import types as genai_types
+    GENAI_AVAILABLE = True
+except ImportError:
+    GENAI_AVAILABLE = False
+
+# Try to import numpy for batched text analysis
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
 import requests
+from requests.adapters import HTTPAdapter
 from PyQt6.QtWidgets import (QApplication, QWidget, QVBoxLayout, QHBoxLayout, 
                            QLabel, QProgressBar, QMessageBox, QPushButton, 
                            QTextEdit, QComboBox, QSpinBox, QCheckBox, QFileDialog,
@@ -63,6 +88,13 @@ EXPIRATION_DATE = datetime.date(2026, 8, 8)
 API_KEYS_FILE = Path.home() / ".bilingual_tts_api_keys.json"
 ENCRYPTION_KEY_FILE = Path.home() / ".bilingual_tts_encryption.key"
 PROMPTS_FILE = Path.home() / ".bilingual_tts_prompts.json"
+API_STATE_FILE = Path.home() / ".bilingual_tts_api_state.json"
+MODEL_CACHE_FILE = Path.home() / ".bilingual_tts_models.json"
+LEXICON_FILE = Path.home() / ".bilingual_tts_lexicon.json"
+RATE_LIMITS_FILE = Path.home() / ".bilingual_tts_rate_limits.json"
+CACHE_DIR = Path.home() / ".bilingual_tts_cache"
+TTS_CACHE_DIR = CACHE_DIR / "audio"
+REWRITE_CACHE_DIR = CACHE_DIR / "rewrite"
 
 # GEMINI MODELS - ĐÃ BỔ SUNG ĐẦY ĐỦ
 # GEMINI MODELS - CHÍNH XÁC CHO v1beta API
@@ -91,6 +123,72 @@ GEMINI_MODELS = {
 # Model mặc định - ỔN ĐỊNH NHẤT
 DEFAULT_TEXT_MODEL = "gemini-1.5-flash"
 
+# Endpoint Gemini REST API (đặt BILINGUAL_TTS_API_ROOT để chạy với benchmarks/mock_gemini_server.py)
+DEFAULT_GEMINI_API_ROOT = "https://generativelanguage.googleapis.com"
+GEMINI_API_ROOT = os.environ.get("BILINGUAL_TTS_API_ROOT", DEFAULT_GEMINI_API_ROOT).rstrip("/")
+GEMINI_API_VERSION = "v1beta"
+
+# Cache model khả dụng (models.list / 404) - hết hạn sau N giây
+MODEL_CACHE_TTL = 6 * 3600
+MODELS_LIST_MAX_PAGES = 20
+
+# TTS song song - số request tối đa đang chạy cùng lúc cho mỗi job
+DEFAULT_TTS_CONCURRENCY = 4
+MAX_TTS_CONCURRENCY = 16
+# Số lần thử tối đa cho 1 đoạn bị rate limit / hết key (thử lại sau cooldown của limiter)
+TTS_CHUNK_MAX_ATTEMPTS = 5
+
+# Phân tích theo lô bằng NumPy cho văn bản từ N ký tự (nhỏ hơn thì chạy từng câu)
+BATCH_ANALYSIS_MIN_CHARS = 5000
+
+# Phân tích song song nhiều tiến trình cho văn bản từ N ký tự (nhỏ hơn thì chi phí tiến trình lấn át)
+PARALLEL_ANALYSIS_MIN_CHARS = 200000
+ANALYSIS_WORKERS = max(1, min(4, (os.cpu_count() or 1) - 1))
+ANALYSIS_SHARDS_PER_WORKER = 4
+
+# Gộp/tách câu thành đoạn TTS (ký tự/đoạn, 0 = mỗi câu 1 đoạn)
+DEFAULT_CHUNK_MAX_CHARS = 300
+MAX_CHUNK_MAX_CHARS = 2000
+
+# HTTP connection pool (keep-alive) cho text API
+DEFAULT_HTTP_POOL_SIZE = 20
+
+# Ghi trạng thái key (stats, cooldown) xuống đĩa tối đa mỗi N giây
+API_STATE_FLUSH_INTERVAL = 5
+
+# Model TTS
+DEFAULT_TTS_MODEL = "gemini-2.0-flash-exp"
+
+# Cache audio TTS trên đĩa (LRU)
+TTS_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+# Cache kết quả viết lại (LRU + TTL)
+REWRITE_CACHE_MAX_BYTES = 200 * 1024 ** 2
+REWRITE_CACHE_TTL = 7 * 24 * 3600
+
+# Generation config mặc định cho text API
+DEFAULT_GENERATION_CONFIG = {
+    "temperature": 0.7,
+    "topK": 40,
+    "topP": 0.95,
+    "maxOutputTokens": 4096,
+}
+
+# Viết lại văn bản dài: chia theo đoạn văn (token ước lượng / phân đoạn)
+LONG_REWRITE_SEGMENT_TOKENS = 1500
+MAX_OUTPUT_TOKENS_CAP = 8192
+REWRITE_OUTPUT_FACTOR = 3  # maxOutputTokens ~ token đầu vào x hệ số
+MAX_REWRITE_CONCURRENCY = 8
+
+# RATE LIMIT theo model (requests/phút, requests/ngày) - trần tùy chọn, mặc định TẮT
+# (quota thật khác nhau giữa free/paid tier; server tự báo 429). Bật bằng RATE_LIMITS_FILE:
+# {"gemini-2.5-flash": {"rpm": 10, "rpd": 250}, "gemini-2.5-flash-preview-tts": {"rpm": 3, "rpd": 15}}
+MODEL_RATE_LIMITS = {}
+DEFAULT_RATE_LIMIT = {"rpm": 0, "rpd": 0}  # 0 = không giới hạn
+
+# Quota ngày (RPD) của Gemini reset lúc nửa đêm giờ Pacific
+QUOTA_RESET_TIMEZONE = "America/Los_Angeles"
+
 # ENHANCED VOICE MAPPING
 GEMINI_VOICES = {
     # VIETNAMESE OPTIMIZED VOICES
@@ -122,6 +220,14 @@ AVAILABLE_STYLES = [
     "nghiêm túc", "thân thiện", "chuyên nghiệp", "hào hứng", "bình tĩnh"
 ]
 
+# THÊM: Từ khóa cho analyze_sentiment_and_style (mở rộng qua LEXICON_FILE)
+DEFAULT_STYLE_LEXICON = {
+    "positive": ['tuyệt', 'tốt', 'hay', 'đẹp', 'vui', 'hạnh phúc', 'thích', 'yêu'],
+    "negative": ['buồn', 'tệ', 'xấu', 'khó', 'đau', 'lo', 'sợ', 'ghét'],
+    "exciting": ['wow', 'amazing', 'tuyệt vời'],
+    "formal": ['tôn kính', 'kính thưa', 'xin phép', 'trân trọng'],
+}
+
 # DEFAULT PROMPTS
 DEFAULT_PROMPTS = {
     "Vui": """Viết lại văn bản này với tông điệu vui vẻ, tích cực và năng động. 
@@ -242,12 +348,129 @@ def clear_saved_api_keys():
             os.remove(API_KEYS_FILE)
         if ENCRYPTION_KEY_FILE.exists():
             os.remove(ENCRYPTION_KEY_FILE)
+        if API_STATE_FILE.exists():
+            os.remove(API_STATE_FILE)
         print("✅ Cleared saved API keys")
         return True
     except Exception as e:
         print(f"⚠️ Error clearing API keys: {e}")
         return False
 
+def api_key_fingerprint(api_key: str) -> str:
+    """ID ổn định của key để lưu state (không lưu key gốc)"""
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+
+# THÊM: Che key trong thông báo lỗi (query ?key=..., header, key dạng AIza...) trước khi lưu/log
+_API_KEY_SECRET_REGEX = re.compile(r"(key=|x-goog-api-key['\"]?\s*[:=]\s*['\"]?)[^&\s'\",}]+|AIza[0-9A-Za-z_\-]{20,}", re.IGNORECASE)
+
+def _redact(text):
+    """Thay mọi API key trong text bằng *** (an toàn để lưu state/log)"""
+    if not text:
+        return text
+    return _API_KEY_SECRET_REGEX.sub(lambda m: f"{m.group(1)}***" if m.group(1) else "***", str(text))
+
+def write_json_atomic(path: Path, data, **dump_kwargs):
+    """THÊM: Ghi JSON qua file tạm riêng (mkstemp cùng thư mục) rồi os.replace - ghi đồng thời không đè file tạm của nhau"""
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, **dump_kwargs)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def save_api_state(keys_state: dict):
+    """Lưu stats/cooldown theo key fingerprint - ghi atomic"""
+    try:
+        data = {
+            'keys': keys_state,
+            'saved_at': datetime.datetime.now().isoformat(),
+            'version': '6.0'
+        }
+        
+        write_json_atomic(API_STATE_FILE, data, ensure_ascii=False)
+        return True
+    except Exception as e:
+        print(f"⚠️ Error saving API state: {e}")
+        return False
+
+def load_api_state() -> dict:
+    try:
+        if not API_STATE_FILE.exists():
+            return {}
+        
+        with open(API_STATE_FILE, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        
+        return data.get('keys', {})
+    except Exception as e:
+        print(f"⚠️ Error loading API state: {e}")
+        return {}
+
+def load_rate_limits() -> dict:
+    """THÊM: Trần RPM/RPD theo model từ RATE_LIMITS_FILE (không có file -> không giới hạn)"""
+    limits = {m: dict(v) for m, v in MODEL_RATE_LIMITS.items()}
+    try:
+        if not RATE_LIMITS_FILE.exists():
+            return limits
+        
+        with open(RATE_LIMITS_FILE, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        
+        for model, values in data.items():
+            if not isinstance(values, dict):
+                print(f"⚠️ Rate limits: bỏ qua '{model}'")
+                continue
+            limits[model] = {
+                "rpm": max(0, float(values.get("rpm") or 0)),
+                "rpd": max(0, int(values.get("rpd") or 0)),
+            }
+        
+        print(f"✅ Loaded rate limits cho {len(limits)} models")
+        return limits
+    except Exception as e:
+        print(f"⚠️ Error loading rate limits: {e}")
+        return {m: dict(v) for m, v in MODEL_RATE_LIMITS.items()}
+
+def save_rate_limits(limits: dict):
+    try:
+        write_json_atomic(RATE_LIMITS_FILE, limits, ensure_ascii=False, indent=2)
+        return True
+    except Exception as e:
+        print(f"⚠️ Error saving rate limits: {e}")
+        return False
+
+def save_model_cache(models: dict, listed_at: float = 0):
+    try:
+        data = {
+            'models': models,
+            'listed_at': listed_at,
+            'saved_at': datetime.datetime.now().isoformat(),
+            'version': '6.0'
+        }
+        
+        write_json_atomic(MODEL_CACHE_FILE, data, indent=2)
+        return True
+    except Exception as e:
+        print(f"⚠️ Error saving model cache: {e}")
+        return False
+
+def load_model_cache() -> Tuple[dict, float]:
+    """-> (models, thời điểm models.list gần nhất)"""
+    try:
+        if not MODEL_CACHE_FILE.exists():
+            return {}, 0
+        
+        with open(MODEL_CACHE_FILE, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        
+        return data.get('models', {}), data.get('listed_at', 0)
+    except Exception as e:
+        print(f"⚠️ Error loading model cache: {e}")
+        return {}, 0
+
 # =====================================
 # PROMPT MANAGEMENT
 # =====================================
@@ -287,6 +510,39 @@ def load_prompts() -> dict:
         print(f"⚠️ Error loading prompts: {e}")
         return DEFAULT_PROMPTS.copy()
 
+# =====================================
+# STYLE LEXICON
+# =====================================
+
+def load_style_lexicon(path: Path = None) -> Dict[str, List[str]]:
+    """THÊM: DEFAULT_STYLE_LEXICON + từ khóa trong file JSON {"positive": [...], "negative": [...], ...}"""
+    lexicon = {category: list(words) for category, words in DEFAULT_STYLE_LEXICON.items()}
+    path = Path(path) if path else LEXICON_FILE
+    try:
+        if not path.exists():
+            return lexicon
+        
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        
+        added = 0
+        for category, words in data.items():
+            if category not in lexicon or not isinstance(words, list):
+                print(f"⚠️ Lexicon: bỏ qua nhóm '{category}'")
+                continue
+            for word in words:
+                # Câu được so khớp sau khi lower(); bỏ từ rỗng và từ trùng
+                word = str(word).strip().lower()
+                if word and word not in lexicon[category]:
+                    lexicon[category].append(word)
+                    added += 1
+        
+        print(f"✅ Loaded lexicon: +{added} từ khóa từ {path}")
+        return lexicon
+    except Exception as e:
+        print(f"⚠️ Error loading lexicon: {e}")
+        return {category: list(words) for category, words in DEFAULT_STYLE_LEXICON.items()}
+
 # =====================================
 # UTILITIES
 # =====================================
@@ -309,30 +565,356 @@ def save_wav_file(filename: str, audio_data: bytes, channels: int = 1, rate: int
         print(f"❌ Error saving WAV file: {e}")
         return False
 
+def merge_wav_files(input_files: list, output_file: str):
+    """Ghép các file WAV (cùng thông số) theo thứ tự, thông số lấy từ file đầu tiên"""
+    with wave.open(output_file, 'wb') as output:
+        for i, file_path in enumerate(input_files):
+            with wave.open(file_path, 'rb') as input_file:
+                if i == 0:
+                    output.setparams(input_file.getparams())
+                output.writeframes(input_file.readframes(input_file.getnframes()))
+    return output_file
+
+# =====================================
+# DISK CACHE
+# =====================================
+
+class DiskCache:
+    """Cache file theo content hash: ghi atomic, giới hạn dung lượng, LRU theo mtime"""
+    
+    def __init__(self, directory, max_bytes: int, suffix: str = ".bin"):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = None  # Tính lazy khi ghi lần đầu
+    
+    @staticmethod
+    def make_key(*parts) -> str:
+        raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+    
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}{self.suffix}"
+    
+    def _files(self):
+        if not self.directory.exists():
+            return []
+        return [p for p in self.directory.glob(f"*/*{self.suffix}") if p.is_file()]
+    
+    def get_path(self, key: str) -> Optional[Path]:
+        """Path của entry nếu có (đánh dấu vừa dùng cho LRU)"""
+        path = self._path(key)
+        try:
+            os.utime(path)
+        except OSError:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return path
+    
+    def get(self, key: str) -> Optional[bytes]:
+        path = self.get_path(key)
+        if path is None:
+            return None
+        try:
+            return path.read_bytes()
+        except OSError:
+            return None
+    
+    def _write_atomic(self, key: str, write_func) -> bool:
+        path = self._path(key)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    write_func(f)
+                new_size = os.path.getsize(tmp_path)
+                old_size = path.stat().st_size if path.exists() else 0
+                os.replace(tmp_path, path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        except Exception as e:
+            print(f"⚠️ Cache write error: {e}")
+            return False
+        
+        with self.lock:
+            if self._size is None:
+                self._size = sum(p.stat().st_size for p in self._files())
+            else:
+                self._size += new_size - old_size
+            over_limit = self._size > self.max_bytes
+        if over_limit:
+            self.evict()
+        return True
+    
+    def put(self, key: str, data: bytes) -> bool:
+        return self._write_atomic(key, lambda f: f.write(data))
+    
+    def put_file(self, key: str, src_path) -> bool:
+        def copy_into(f):
+            with open(src_path, 'rb') as src:
+                shutil.copyfileobj(src, f, 1024 * 1024)
+        return self._write_atomic(key, copy_into)
+    
+    def evict(self):
+        """Xóa entry dùng lâu nhất đến khi còn <= 90% dung lượng tối đa"""
+        with self.lock:
+            entries = []
+            for p in self._files():
+                try:
+                    st = p.stat()
+                    entries.append((st.st_mtime, st.st_size, p))
+                except OSError:
+                    continue
+            entries.sort()
+            size = sum(e[1] for e in entries)
+            target = int(self.max_bytes * 0.9)
+            for _, file_size, p in entries:
+                if size <= target:
+                    break
+                try:
+                    p.unlink()
+                    size -= file_size
+                    self.evictions += 1
+                except OSError:
+                    continue
+            self._size = size
+    
+    def clear(self):
+        with self.lock:
+            for p in self._files():
+                try:
+                    p.unlink()
+                except OSError:
+                    pass
+            self._size = 0
+    
+    def stats(self) -> Dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0,
+                "size_bytes": self._size,
+                "max_bytes": self.max_bytes,
+            }
+
+
+class TTSAudioCache(DiskCache):
+    """Cache WAV theo (text chuẩn hóa, voice, model TTS, thông số audio)"""
+    
+    def __init__(self, directory=TTS_CACHE_DIR, max_bytes: int = TTS_CACHE_MAX_BYTES):
+        super().__init__(directory, max_bytes, suffix=".wav")
+    
+    @staticmethod
+    def normalize_text(text: str) -> str:
+        text = unicodedata.normalize('NFC', text or '')
+        return re.sub(r'\s+', ' ', text).strip()
+    
+    def make_audio_key(self, text: str, voice: str, model: str,
+                       channels: int = 1, rate: int = 24000, sample_width: int = 2) -> str:
+        return self.make_key(self.normalize_text(text), voice, model, channels, rate, sample_width)
+    
+    def copy_to(self, key: str, dest_path) -> bool:
+        """Cache hit -> copy file WAV ra dest_path"""
+        path = self.get_path(key)
+        if path is None:
+            return False
+        try:
+            shutil.copyfile(path, dest_path)
+            return True
+        except OSError:
+            return False
+
+
+class RewriteCache(DiskCache):
+    """Cache kết quả viết lại theo (prompt, văn bản, model, generation config) có TTL"""
+    
+    def __init__(self, directory=REWRITE_CACHE_DIR, max_bytes: int = REWRITE_CACHE_MAX_BYTES,
+                 ttl: float = REWRITE_CACHE_TTL):
+        super().__init__(directory, max_bytes, suffix=".json")
+        self.ttl = ttl
+    
+    def make_rewrite_key(self, prompt_template: str, text: str, model: str, generation_config: dict) -> str:
+        return self.make_key(
+            hashlib.sha256(prompt_template.encode('utf-8')).hexdigest(),
+            hashlib.sha256(text.encode('utf-8')).hexdigest(),
+            model,
+            generation_config,
+        )
+    
+    def get_text(self, key: str) -> Optional[str]:
+        data = self.get(key)
+        if data is None:
+            return None
+        try:
+            entry = json.loads(data.decode('utf-8'))
+            if time.time() - entry.get("created_at", 0) <= self.ttl:
+                return entry["text"]
+        except Exception:
+            pass
+        # Hết hạn hoặc hỏng -> tính là miss
+        with self.lock:
+            self.hits -= 1
+            self.misses += 1
+        try:
+            self._path(key).unlink()
+        except OSError:
+            pass
+        return None
+    
+    def put_text(self, key: str, text: str) -> bool:
+        entry = {"text": text, "created_at": time.time()}
+        return self.put(key, json.dumps(entry, ensure_ascii=False).encode('utf-8'))
+
+
+_tts_audio_cache = None
+_rewrite_cache = None
+
+def get_tts_audio_cache() -> TTSAudioCache:
+    global _tts_audio_cache
+    if _tts_audio_cache is None:
+        _tts_audio_cache = TTSAudioCache()
+    return _tts_audio_cache
+
+def get_rewrite_cache() -> RewriteCache:
+    global _rewrite_cache
+    if _rewrite_cache is None:
+        _rewrite_cache = RewriteCache()
+    return _rewrite_cache
+
 # =====================================
 # TEXT PROCESSOR V6.0
 # =====================================
 
+class _CharClassTable(dict):
+    """Bảng codepoint -> lớp ký tự cho str.translate, tính lazy và nhớ lại theo từng ký tự"""
+    
+    def __init__(self, classify):
+        super().__init__()
+        self.classify = classify
+    
+    def __missing__(self, codepoint):
+        value = self.classify(chr(codepoint))
+        self[codepoint] = value
+        return value
+
+
+class KeywordMatcher:
+    """THÊM: Đếm từ khóa của mọi nhóm trong 1 lượt quét văn bản.
+    
+    Kết quả giống `sum(1 for word in words if word in text)` cho từng nhóm: đếm số từ khác nhau
+    xuất hiện dưới dạng chuỗi con, kể cả khi chồng lên nhau. Các từ được dựng thành 1 regex dạng trie
+    trong lookahead, mỗi vị trí cho từ dài nhất bắt đầu tại đó; các từ ngắn hơn cùng vị trí chính là
+    tiền tố của nó nên lấy từ bảng _prefixes.
+    """
+    
+    def __init__(self, lexicon: Dict[str, List[str]]):
+        self.categories = list(lexicon)
+        self._categories_by_word = {}
+        for category, words in lexicon.items():
+            for word in words:
+                if word:
+                    self._categories_by_word.setdefault(word, []).append(category)
+        
+        self._prefixes = {
+            word: [word[:i] for i in range(1, len(word) + 1) if word[:i] in self._categories_by_word]
+            for word in self._categories_by_word
+        }
+        self._regex = None
+        if self._categories_by_word:
+            self._regex = re.compile('(?=(' + self._trie_pattern(self._categories_by_word) + '))')
+    
+    @staticmethod
+    def _trie_pattern(words) -> str:
+        trie = {}
+        for word in words:
+            node = trie
+            for ch in word:
+                node = node.setdefault(ch, {})
+            node[''] = {}
+        
+        def build(node):
+            branches = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+            if not branches:
+                return ''
+            body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+            # Phần tiếp theo tùy chọn khi đã hết 1 từ - greedy nên ưu tiên từ dài hơn
+            return '(?:' + body + ')?' if '' in node else body
+        
+        return build(trie)
+    
+    def count(self, text: str) -> Dict[str, int]:
+        counts = dict.fromkeys(self.categories, 0)
+        if self._regex is None:
+            return counts
+        
+        found = set()
+        for longest in set(self._regex.findall(text)):
+            found.update(self._prefixes[longest])
+        for word in found:
+            for category in self._categories_by_word[word]:
+                counts[category] += 1
+        return counts
+
+
+_style_keyword_matcher = None
+
+def get_style_keyword_matcher() -> KeywordMatcher:
+    global _style_keyword_matcher
+    if _style_keyword_matcher is None:
+        _style_keyword_matcher = KeywordMatcher(load_style_lexicon())
+    return _style_keyword_matcher
+
+
 class EnhancedTextProcessor:
     """Enhanced text processing with improved Japanese detection"""
     
-    def __init__(self):
-        self.japanese_patterns = [
-            r'[ひらがな-ゟ]',
-            r'[カタカナ-ヿ]',
-            r'[一-龯]',
-            r'[。！？．｡]',
-            r'「[^」]*」',
-            r'（[^）]*）',
-            r'[ー〜～]',
-            r'です|ます|だ|である',
-            r'は|が|を|に|で|と|から',
-        ]
+    # THÊM: Lớp ký tự cho bộ đếm 1 lượt (extract_features)
+    CLASS_JA = 'J'        # tính điểm japanese_regex + thuộc dải kana/CJK
+    CLASS_JA_PUNCT = 'j'  # tính điểm japanese_regex, ngoài dải kana/CJK (。！？〜...)
+    CLASS_JA_DE = 'D'     # で (cần để trừ "である")
+    CLASS_KANA = 'R'      # chỉ thuộc dải kana/CJK
+    CLASS_SPAN = 'Q'      # 「 （ - mở cụm 「...」/（...）
+    CLASS_VI = 'V'        # ký tự có dấu tiếng Việt
+    CLASS_LATIN = 'L'     # [a-zA-Z]
+    CLASS_SPACE = ' '
+    CHAR_CLASSES = 'JjDRQVL '
+    
+    # THÊM: plan_chunks chỉ gộp câu liền kề khi các trường này giống nhau (1 đoạn = 1 cách đọc)
+    CHUNK_MERGE_FIELDS = ("language", "voice", "style", "emotion", "speed")
+    
+    def __init__(self, lexicon: Dict[str, List[str]] = None):
+        # THÊM: Đặt tên cho từng pattern (dùng lại khi dựng _japanese_char_regex / _vietnamese_char_regex)
+        self.japanese_named_patterns = {
+            "hiragana": r'[ひらがな-ゟ]',
+            "katakana": r'[カタカナ-ヿ]',
+            "kanji": r'[一-龯]',
+            "punctuation": r'[。！？．｡]',
+            "quote": r'「[^」]*」',
+            "paren": r'（[^）]*）',
+            "long_vowel": r'[ー〜～]',
+            "copula": r'です|ます|だ|である',
+            "particle": r'は|が|を|に|で|と|から',
+        }
+        self.japanese_patterns = list(self.japanese_named_patterns.values())
         
-        self.vietnamese_patterns = [
-            r'[àáạảãâầấậẩẫăằắặẳẵèéẹẻẽêềếệểễìíịỉĩòóọỏõôồốộổỗơờớợởỡùúụủũưừứựửữỳýỵỷỹđ]',
-            r'\b(và|của|trong|với|để|có|là|được|những|các|này|đó)\b',
-        ]
+        self.vietnamese_named_patterns = {
+            "diacritics": r'[àáạảãâầấậẩẫăằắặẳẵèéẹẻẽêềếệểễìíịỉĩòóọỏõôồốộổỗơờớợởỡùúụủũưừứựửữỳýỵỷỹđ]',
+            "function_words": r'\b(và|của|trong|với|để|có|là|được|những|các|này|đó)\b',
+        }
+        self.vietnamese_patterns = list(self.vietnamese_named_patterns.values())
         
         self.japanese_regex = re.compile('|'.join(self.japanese_patterns), re.IGNORECASE)
         self.vietnamese_regex = re.compile('|'.join(self.vietnamese_patterns), re.IGNORECASE)
@@ -345,36 +927,107 @@ class EnhancedTextProcessor:
             r'[🔥💡🔔🔕🔐🔒🔓🔑]',
         ]
         self.icon_regex = re.compile('|'.join(self.icon_patterns), re.IGNORECASE)
+        
+        # THÊM: Phần 1 ký tự của japanese_regex / vietnamese_regex, dùng để dựng bảng lớp ký tự:
+        # các lớp ký tự + từ 1 ký tự trong copula/particle (「...」/（...） và từ nhiều ký tự tính riêng)
+        single_char_words = [
+            word for name in ("copula", "particle")
+            for word in self.japanese_named_patterns[name].split('|') if len(word) == 1
+        ]
+        self._japanese_char_regex = re.compile('|'.join(
+            [self.japanese_named_patterns[name]
+             for name in ("hiragana", "katakana", "kanji", "punctuation", "long_vowel")] + single_char_words
+        ), re.IGNORECASE)
+        self._vietnamese_char_regex = re.compile(self.vietnamese_named_patterns["diacritics"], re.IGNORECASE)
+        self._trong_regex = re.compile(r'\btrong\b', re.IGNORECASE)
+        self._span_open_regex = re.compile('[「（]')
+        self._char_classes = _CharClassTable(self._classify_char)
+        
+        # THÊM: Từ khóa phong cách - mặc định dùng chung matcher (DEFAULT_STYLE_LEXICON + LEXICON_FILE)
+        self.keyword_matcher = KeywordMatcher(lexicon) if lexicon is not None else get_style_keyword_matcher()
     
-    def clean_text(self, text: str) -> str:
-        if not text:
-            return ""
-        cleaned = self.icon_regex.sub('', text)
-        cleaned = re.sub(r'\s+', ' ', cleaned)
-        return cleaned.strip()
+    def _classify_char(self, ch: str):
+        if ch == 'で':
+            return self.CLASS_JA_DE
+        in_kana_range = ('\u3040' <= ch <= '\u309F' or
+                         '\u30A0' <= ch <= '\u30FF' or
+                         '\u4E00' <= ch <= '\u9FAF')
+        if self._japanese_char_regex.fullmatch(ch):
+            return self.CLASS_JA if in_kana_range else self.CLASS_JA_PUNCT
+        if in_kana_range:
+            return self.CLASS_KANA
+        if ch in '「（':
+            return self.CLASS_SPAN
+        if self._vietnamese_char_regex.fullmatch(ch):
+            return self.CLASS_VI
+        if 'a' <= ch <= 'z' or 'A' <= ch <= 'Z':
+            return self.CLASS_LATIN
+        if ch == ' ':
+            return self.CLASS_SPACE
+        return None  # Bỏ qua
     
-    def detect_language_enhanced(self, text: str) -> str:
-        if not text:
-            return 'unknown'
-        
-        cleaned_text = self.clean_text(text)
-        
-        japanese_matches = self.japanese_regex.findall(cleaned_text)
-        vietnamese_matches = self.vietnamese_regex.findall(cleaned_text)
+    def _japanese_char_score(self, text: str) -> int:
+        counts = text.translate(self._char_classes)
+        return (counts.count(self.CLASS_JA) + counts.count(self.CLASS_JA_PUNCT)
+                + counts.count(self.CLASS_JA_DE) - text.count('である'))
+    
+    def _japanese_span_score(self, text: str) -> int:
+        """Điểm japanese_regex khi có 「 （: mỗi cụm tới dấu đóng đầu tiên tính 1 match"""
+        score = 0
+        pos = 0
+        while True:
+            match = self._span_open_regex.search(text, pos)
+            end = match.start() if match else len(text)
+            score += self._japanese_char_score(text[pos:end])
+            if not match:
+                return score
+            close = text.find('」' if match.group() == '「' else '）', match.end())
+            if close == -1:
+                pos = match.end()  # Không có dấu đóng -> ký tự mở không khớp gì
+            else:
+                score += 1
+                pos = close + 1
+    
+    def extract_features(self, text: str) -> Dict:
+        """THÊM: Đếm 1 lượt qua bảng lớp ký tự - cho cùng số liệu như japanese_regex/vietnamese_regex.
         
-        japanese_score = len(japanese_matches)
-        vietnamese_score = len(vietnamese_matches)
+        japanese_score = len(japanese_regex.findall(text)), vietnamese_score = len(vietnamese_regex.findall(text)).
+        """
+        classes = text.translate(self._char_classes)
+        counts = {c: classes.count(c) for c in self.CHAR_CLASSES}
         
-        total_chars = len(cleaned_text.replace(' ', ''))
+        if counts[self.CLASS_SPAN]:
+            japanese_score = self._japanese_span_score(text)
+        else:
+            japanese_score = counts[self.CLASS_JA] + counts[self.CLASS_JA_PUNCT] + counts[self.CLASS_JA_DE]
+            if counts[self.CLASS_JA_DE]:
+                # "である" là 1 match thay cho で + る
+                japanese_score -= text.count('である')
+        
+        vietnamese_score = counts[self.CLASS_VI]
+        if counts[self.CLASS_LATIN] >= 5:
+            # "trong" không có dấu nên chỉ được đếm qua nhánh từ khóa
+            vietnamese_score += len(self._trong_regex.findall(text))
+        
+        return {
+            "length": len(text),
+            "total_chars": len(text) - counts[self.CLASS_SPACE],
+            "japanese_score": japanese_score,
+            "vietnamese_score": vietnamese_score,
+            "japanese_chars": counts[self.CLASS_JA] + counts[self.CLASS_JA_DE] + counts[self.CLASS_KANA],
+            "latin_chars": counts[self.CLASS_LATIN],
+        }
+    
+    @staticmethod
+    def _language_from_features(features: Dict) -> str:
+        total_chars = features["total_chars"]
         if total_chars == 0:
             return 'unknown'
         
-        japanese_char_ratio = sum(1 for char in cleaned_text if 
-                                 '\u3040' <= char <= '\u309F' or
-                                 '\u30A0' <= char <= '\u30FF' or
-                                 '\u4E00' <= char <= '\u9FAF') / total_chars
-        
-        vietnamese_char_ratio = len(self.vietnamese_regex.findall(cleaned_text)) / total_chars
+        japanese_score = features["japanese_score"]
+        vietnamese_score = features["vietnamese_score"]
+        japanese_char_ratio = features["japanese_chars"] / total_chars
+        vietnamese_char_ratio = vietnamese_score / total_chars
         
         if japanese_char_ratio > 0.15 or japanese_score >= 3:
             return 'ja'
@@ -385,32 +1038,180 @@ class EnhancedTextProcessor:
         elif vietnamese_char_ratio > 0.02:
             return 'vi'
         else:
-            latin_chars = len(re.findall(r'[a-zA-Z]', cleaned_text))
-            if latin_chars > total_chars * 0.5:
+            if features["latin_chars"] > total_chars * 0.5:
                 return 'vi'
             else:
                 return 'mixed'
     
+    @staticmethod
+    def _confidence_from_features(features: Dict, detected_lang: str) -> float:
+        if not features["length"]:
+            return 0.0
+        
+        base_confidence = min(0.8, features["length"] / 50)
+        total_chars = features["total_chars"]
+        
+        if detected_lang in ('ja', 'vi'):
+            score = features["japanese_score"] if detected_lang == 'ja' else features["vietnamese_score"]
+            if total_chars > 0:
+                lang_ratio = score / total_chars
+                confidence = base_confidence + (lang_ratio * 0.2)
+            else:
+                confidence = base_confidence
+        else:
+            confidence = base_confidence * 0.7
+        
+        return min(1.0, max(0.1, confidence))
+    
+    def _language_and_confidence(self, sentence: str) -> Tuple[str, float]:
+        """THÊM: Ngôn ngữ + độ tin cậy từ cùng một lượt đếm"""
+        features = self.extract_features(sentence)
+        language = self._language_from_features(features)
+        return language, self._confidence_from_features(features, language)
+    
+    def clean_text(self, text: str) -> str:
+        if not text:
+            return ""
+        cleaned = self.icon_regex.sub('', text)
+        cleaned = re.sub(r'\s+', ' ', cleaned)
+        return cleaned.strip()
+    
+    def detect_language_enhanced(self, text: str) -> str:
+        if not text:
+            return 'unknown'
+        
+        cleaned_text = self.clean_text(text)
+        return self._language_from_features(self.extract_features(cleaned_text))
+    
     def sentence_split(self, text: str) -> List[str]:
         sentences = re.split(r'[.!?。！？]\s*', text)
         sentences = [s.strip() for s in sentences if s.strip()]
         return sentences
     
+    def split_long_sentence(self, sentence: str, max_chars: int, language: str = None) -> List[str]:
+        """THÊM: Tách câu quá dài tại ranh giới mệnh đề, rồi khoảng trắng, cuối cùng cắt cứng.
+        
+        language == "JAPANESE": ghép lại các mảnh không chèn khoảng trắng.
+        """
+        if len(sentence) <= max_chars:
+            return [sentence]
+        
+        joiner = "" if language == "JAPANESE" else " "
+        
+        pieces = []
+        for clause in re.split(r'(?<=[,;:、，；])\s*', sentence):
+            if len(clause) <= max_chars:
+                pieces.append(clause)
+                continue
+            for word in clause.split():
+                # Tiếng Nhật không có khoảng trắng -> cắt cứng
+                pieces.extend(word[j:j + max_chars] for j in range(0, len(word), max_chars))
+        
+        parts = []
+        current = ""
+        for piece in pieces:
+            if not piece:
+                continue
+            if current and len(current) + len(joiner) + len(piece) > max_chars:
+                parts.append(current)
+                current = piece
+            else:
+                current = f"{current}{joiner}{piece}" if current else piece
+        if current:
+            parts.append(current)
+        return parts
+    
+    def plan_chunks(self, analysis: List[Dict], max_chars: int = DEFAULT_CHUNK_MAX_CHARS) -> List[Dict]:
+        """THÊM: Gộp câu liền kề cùng ngôn ngữ, giọng, phong cách, cảm xúc, tốc độ đến max_chars;
+        tách câu quá dài.
+        
+        Mỗi đoạn có "sentences" = index các câu trong analysis (theo sentence_split).
+        """
+        chunks = []
+        current = None
+        
+        def flush():
+            nonlocal current
+            if current is not None:
+                weights = current.pop("_weights")
+                total = sum(w for w, _ in weights)
+                if total > 0:
+                    current["confidence"] = sum(w * c for w, c in weights) / total
+                chunks.append(current)
+                current = None
+        
+        for i, entry in enumerate(analysis):
+            text = entry["text"]
+            
+            if max_chars <= 0:
+                chunks.append({**entry, "sentences": [i]})
+                continue
+            
+            if len(text) > max_chars:
+                flush()
+                for part in self.split_long_sentence(text, max_chars, entry["language"]):
+                    chunks.append({**entry, "text": part, "sentences": [i]})
+                continue
+            
+            separator = "。" if entry["language"] == "JAPANESE" else ". "
+            if (current is not None
+                    and all(current.get(field) == entry.get(field) for field in self.CHUNK_MERGE_FIELDS)
+                    and len(current["text"]) + len(separator) + len(text) <= max_chars):
+                current["text"] += separator + text
+                current["sentences"].append(i)
+                current["_weights"].append((len(text), entry.get("confidence", 0.0)))
+            else:
+                flush()
+                current = {**entry, "sentences": [i],
+                           "_weights": [(len(text), entry.get("confidence", 0.0))]}
+        
+        flush()
+        return chunks
+    
+    def replan_chunks(self, previous_chunks: List[Dict], analysis: List[Dict], reused: Dict[int, int],
+                      max_chars: int = DEFAULT_CHUNK_MAX_CHARS) -> List[Dict]:
+        """THÊM: Lập lại đoạn sau update_style_analysis, giữ nguyên đoạn chỉ gồm câu không đổi.
+        
+        previous_chunks phải lập bằng plan_chunks với cùng max_chars. Đoạn cũ được giữ (text giống hệt,
+        audio cache vẫn dùng được) khi mọi câu của nó được giữ lại và vẫn liền nhau; các câu còn lại
+        lập bằng plan_chunks theo từng khoảng giữa các đoạn giữ lại.
+        """
+        kept = {}  # index câu mới đầu tiên -> các đoạn cũ (câu quá dài có thể thành nhiều đoạn)
+        for chunk in previous_chunks:
+            indices = [reused.get(i) for i in chunk["sentences"]]
+            if None in indices or indices != list(range(indices[0], indices[0] + len(indices))):
+                continue
+            kept.setdefault(indices[0], []).append({**chunk, "sentences": indices})
+        
+        chunks = []
+        pending = []
+        
+        def flush():
+            for chunk in self.plan_chunks([analysis[i] for i in pending], max_chars):
+                chunks.append({**chunk, "sentences": [pending[k] for k in chunk["sentences"]]})
+            pending.clear()
+        
+        i = 0
+        while i < len(analysis):
+            if i in kept:
+                flush()
+                chunks.extend(kept[i])
+                i = kept[i][-1]["sentences"][-1] + 1
+            else:
+                pending.append(i)
+                i += 1
+        flush()
+        return chunks
+    
     def analyze_sentiment_and_style(self, text: str) -> Dict:
         if not text:
             return {"style": "bình thường", "emotion": "neutral", "speed": "bình thường"}
         
-        text_lower = text.lower()
-        
-        positive_words = ['tuyệt', 'tốt', 'hay', 'đẹp', 'vui', 'hạnh phúc', 'thích', 'yêu']
-        negative_words = ['buồn', 'tệ', 'xấu', 'khó', 'đau', 'lo', 'sợ', 'ghét']
-        exciting_words = ['wow', 'amazing', 'tuyệt vời']
-        formal_words = ['tôn kính', 'kính thưa', 'xin phép', 'trân trọng']
-        
-        positive_count = sum(1 for word in positive_words if word in text_lower)
-        negative_count = sum(1 for word in negative_words if word in text_lower)
-        exciting_count = sum(1 for word in exciting_words if word in text_lower)
-        formal_count = sum(1 for word in formal_words if word in text_lower)
+        counts = self.keyword_matcher.count(text.lower())
+        positive_count = counts.get('positive', 0)
+        negative_count = counts.get('negative', 0)
+        exciting_count = counts.get('exciting', 0)
+        formal_count = counts.get('formal', 0)
         
         if exciting_count > 0:
             return {"style": "hào hứng", "emotion": "excited", "speed": "nhanh"}
@@ -423,12 +1224,146 @@ class EnhancedTextProcessor:
         else:
             return {"style": "bình thường", "emotion": "neutral", "speed": "bình thường"}
     
-    def create_style_analysis_json(self, text: str, voice_mappings: dict = None) -> List[Dict]:
+    def sentence_spans(self, text: str) -> List[Tuple[int, int]]:
+        """THÊM: Vị trí (start, end) các câu như sentence_split - text[start:end] == câu"""
+        spans = []
+        pos = 0
+        for match in itertools.chain(re.finditer(r'[.!?。！？]\s*', text), [None]):
+            end = match.start() if match else len(text)
+            piece = text[pos:end]
+            stripped = piece.strip()
+            if stripped:
+                start = pos + len(piece) - len(piece.lstrip())
+                spans.append((start, start + len(stripped)))
+            if match:
+                pos = match.end()
+        return spans
+    
+    def _analyze_languages_batched(self, text: str, spans: List[Tuple[int, int]]) -> Tuple[List[str], List[float]]:
+        """THÊM: Ngôn ngữ + độ tin cậy cho mọi câu cùng lúc bằng NumPy.
+        
+        Mã hóa cả văn bản thành mảng codepoint, lớp ký tự lấy từ cùng bảng với extract_features,
+        đếm theo câu bằng cumsum (start/end). Câu có 「 （ tính lại điểm bằng _japanese_span_score.
+        """
+        codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+        uniques = np.unique(codes)
+        class_index = {c: i for i, c in enumerate(self.CHAR_CLASSES)}
+        # Bảng tra dày theo codepoint (tối đa ~1.1MB int8), chỉ điền các ký tự có trong văn bản
+        lut = np.full(int(uniques[-1]) + 1, len(self.CHAR_CLASSES), dtype=np.int8)
+        lut[uniques] = [class_index.get(self._char_classes[int(c)], len(self.CHAR_CLASSES)) for c in uniques]
+        classes = lut[codes]
+        del codes, uniques
+        
+        starts = np.array([s for s, _ in spans], dtype=np.int64)
+        ends = np.array([e for _, e in spans], dtype=np.int64)
+        counts = {}
+        for c, i in class_index.items():
+            cumulative = np.zeros(len(classes) + 1, dtype=np.int32)
+            np.cumsum(classes == i, dtype=np.int32, out=cumulative[1:])
+            counts[c] = (cumulative[ends] - cumulative[starts]).astype(np.int64)
+        
+        def per_sentence(positions):
+            """Số lần xuất hiện theo câu (mẫu không chứa dấu câu/khoảng trắng nên luôn nằm trọn trong 1 câu)"""
+            if not positions:
+                return np.zeros(len(spans), dtype=np.int64)
+            index = np.searchsorted(starts, np.array(positions, dtype=np.int64), side='right') - 1
+            return np.bincount(index, minlength=len(spans))
+        
+        lengths = ends - starts
+        total = lengths - counts[self.CLASS_SPACE]
+        japanese_chars = counts[self.CLASS_JA] + counts[self.CLASS_JA_DE] + counts[self.CLASS_KANA]
+        latin = counts[self.CLASS_LATIN]
+        japanese_score = counts[self.CLASS_JA] + counts[self.CLASS_JA_PUNCT] + counts[self.CLASS_JA_DE]
+        if counts[self.CLASS_JA_DE].any():
+            japanese_score = japanese_score - per_sentence([m.start() for m in re.finditer('である', text)])
+        vietnamese_score = counts[self.CLASS_VI] + per_sentence(
+            [m.start() for m in self._trong_regex.finditer(text)]
+        )
+        
+        # Câu có cụm 「...」/（...）: điểm tiếng Nhật tính riêng
+        for i in np.flatnonzero(counts[self.CLASS_SPAN]):
+            start, end = spans[i]
+            japanese_score[i] = self._japanese_span_score(text[start:end])
+        
+        # Cùng công thức và thứ tự phép tính với _language_from_features / _confidence_from_features
+        safe_total = np.maximum(total, 1)
+        japanese_ratio = japanese_chars / safe_total
+        vietnamese_ratio = vietnamese_score / safe_total
+        languages = np.select(
+            [total == 0,
+             (japanese_ratio > 0.15) | (japanese_score >= 3),
+             (vietnamese_ratio > 0.1) | (vietnamese_score >= 2),
+             japanese_ratio > 0.05,
+             vietnamese_ratio > 0.02,
+             latin > total * 0.5],
+            ['unknown', 'ja', 'vi', 'ja', 'vi', 'vi'],
+            'mixed'
+        )
+        
+        base = np.minimum(0.8, lengths / 50)
+        is_ja = languages == 'ja'
+        is_vi = languages == 'vi'
+        score = np.where(is_ja, japanese_score, vietnamese_score)
+        confidence = np.where(
+            is_ja | is_vi,
+            np.where(total > 0, base + (score / safe_total * 0.2), base),
+            base * 0.7
+        )
+        confidence = np.minimum(1.0, np.maximum(0.1, confidence))
+        return languages.tolist(), confidence.tolist()
+    
+    def parallel_analysis_enabled(self, length: int) -> bool:
+        """THÊM: Dùng process pool khi văn bản đủ dài; tiến trình con chỉ có lexicon mặc định"""
+        return (ANALYSIS_WORKERS > 1 and length >= PARALLEL_ANALYSIS_MIN_CHARS
+                and self.keyword_matcher is get_style_keyword_matcher())
+    
+    def _create_style_analysis_parallel(self, cleaned_text: str, voice_mappings: dict = None) -> List[Dict]:
+        """THÊM: Chia danh sách câu thành các shard liền nhau, phân tích trên process pool, ghép lại theo thứ tự.
+        
+        Mỗi shard là đoạn cleaned_text từ đầu câu đầu tới cuối câu cuối của shard - sentence_split trên
+        đoạn đó cho đúng các câu ấy, và mỗi câu được phân tích độc lập nên kết quả giống chạy tuần tự.
+        """
+        spans = self.sentence_spans(cleaned_text)
+        shard_count = min(len(spans), ANALYSIS_WORKERS * ANALYSIS_SHARDS_PER_WORKER)
+        if shard_count < 2:
+            return self.create_style_analysis_json(cleaned_text, voice_mappings, parallel=False)
+        
+        bounds = [len(spans) * k // shard_count for k in range(shard_count + 1)]
+        shards = [(cleaned_text[spans[a][0]:spans[b - 1][1]], voice_mappings)
+                  for a, b in zip(bounds, bounds[1:])]
+        try:
+            results = list(get_analysis_pool().map(_analyze_shard, shards))
+        except Exception as e:
+            print(f"⚠️ Phân tích song song lỗi, chạy tuần tự: {e}")
+            shutdown_analysis_pool()
+            return self.create_style_analysis_json(cleaned_text, voice_mappings, parallel=False)
+        
+        return [entry for shard in results for entry in shard]
+    
+    def create_style_analysis_json(self, text: str, voice_mappings: dict = None,
+                                   parallel: bool = None) -> List[Dict]:
+        """parallel: None = tự chọn theo PARALLEL_ANALYSIS_MIN_CHARS, False = luôn tuần tự"""
         if not text:
             return []
         
         cleaned_text = self.clean_text(text)
-        sentences = self.sentence_split(cleaned_text)
+        
+        if parallel is None:
+            parallel = self.parallel_analysis_enabled(len(cleaned_text))
+        if parallel:
+            return self._create_style_analysis_parallel(cleaned_text, voice_mappings)
+        
+        if NUMPY_AVAILABLE and len(cleaned_text) >= BATCH_ANALYSIS_MIN_CHARS:
+            spans = self.sentence_spans(cleaned_text)
+            sentences = [cleaned_text[start:end] for start, end in spans]
+            languages, confidences = self._analyze_languages_batched(cleaned_text, spans) if spans else ([], [])
+        else:
+            sentences = self.sentence_split(cleaned_text)
+            languages, confidences = [], []
+            for sentence in sentences:
+                language, confidence = self._language_and_confidence(sentence)
+                languages.append(language)
+                confidences.append(confidence)
         
         analysis_result = []
         
@@ -436,64 +1371,216 @@ class EnhancedTextProcessor:
             if not sentence.strip():
                 continue
             
-            language = self.detect_language_enhanced(sentence)
-            style_info = self.analyze_sentiment_and_style(sentence)
-            
-            if voice_mappings:
-                if language == 'ja':
-                    voice = voice_mappings.get('japanese', 'Kore')
-                elif language == 'vi':
-                    voice = voice_mappings.get('vietnamese', 'Zephyr')
-                else:
-                    voice = voice_mappings.get('mixed', 'Charon')
-            else:
-                if language == 'ja':
-                    voice = 'Kore'
-                elif language == 'vi':
-                    voice = 'Zephyr'
-                else:
-                    voice = 'Charon'
-            
-            analysis_entry = {
-                "text": sentence.strip(),
-                "language": "JAPANESE" if language == 'ja' else "vietnamese" if language == 'vi' else "mixed",
-                "voice": voice,
-                "style": style_info["style"],
-                "speed": style_info["speed"],
-                "emotion": style_info["emotion"],
-                "confidence": self._calculate_confidence(sentence, language)
-            }
-            
-            analysis_result.append(analysis_entry)
+            analysis_result.append(self._style_entry(sentence, languages[i], confidences[i], voice_mappings))
         
         return analysis_result
     
+    def _voice_for(self, language: str, voice_mappings: dict = None) -> str:
+        if voice_mappings:
+            if language == 'ja':
+                return voice_mappings.get('japanese', 'Kore')
+            elif language == 'vi':
+                return voice_mappings.get('vietnamese', 'Zephyr')
+            return voice_mappings.get('mixed', 'Charon')
+        if language == 'ja':
+            return 'Kore'
+        elif language == 'vi':
+            return 'Zephyr'
+        return 'Charon'
+    
+    def _style_entry(self, sentence: str, language: str, confidence: float, voice_mappings: dict = None) -> Dict:
+        style_info = self.analyze_sentiment_and_style(sentence)
+        return {
+            "text": sentence.strip(),
+            "language": "JAPANESE" if language == 'ja' else "vietnamese" if language == 'vi' else "mixed",
+            "voice": self._voice_for(language, voice_mappings),
+            "style": style_info["style"],
+            "speed": style_info["speed"],
+            "emotion": style_info["emotion"],
+            "confidence": confidence
+        }
+    
+    def update_style_analysis(self, previous: List[Dict], text: str,
+                              voice_mappings: dict = None) -> Tuple[List[Dict], Dict[int, int]]:
+        """THÊM: Phân tích lại văn bản đã sửa, chỉ phân tích các câu thay đổi.
+        
+        So danh sách câu mới với previous bằng difflib; câu không đổi (cùng giọng) giữ nguyên entry cũ
+        (cùng object). Kết quả giống create_style_analysis_json(text, voice_mappings).
+        Trả về (analysis, reused) với reused = {index câu cũ: index câu mới} của các entry giữ lại.
+        """
+        sentences = self.sentence_split(self.clean_text(text)) if text else []
+        matcher = difflib.SequenceMatcher(None, [entry["text"] for entry in previous], sentences, autojunk=False)
+        language_codes = {"JAPANESE": 'ja', "vietnamese": 'vi'}
+        
+        analysis = []
+        reused = {}
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            for k in range(j2 - j1):
+                if tag == 'equal':
+                    entry = previous[i1 + k]
+                    language = language_codes.get(entry["language"], 'mixed')
+                    if entry["voice"] == self._voice_for(language, voice_mappings):
+                        reused[i1 + k] = len(analysis)
+                        analysis.append(entry)
+                        continue
+                
+                sentence = sentences[j1 + k]
+                language, confidence = self._language_and_confidence(sentence)
+                analysis.append(self._style_entry(sentence, language, confidence, voice_mappings))
+        
+        return analysis, reused
+    
     def _calculate_confidence(self, text: str, detected_lang: str) -> float:
         if not text:
             return 0.0
-        
-        base_confidence = min(0.8, len(text) / 50)
-        
-        if detected_lang == 'ja':
-            japanese_chars = len(self.japanese_regex.findall(text))
-            total_chars = len(text.replace(' ', ''))
-            if total_chars > 0:
-                lang_ratio = japanese_chars / total_chars
-                confidence = base_confidence + (lang_ratio * 0.2)
-            else:
-                confidence = base_confidence
-        elif detected_lang == 'vi':
-            vietnamese_chars = len(self.vietnamese_regex.findall(text))
-            total_chars = len(text.replace(' ', ''))
-            if total_chars > 0:
-                lang_ratio = vietnamese_chars / total_chars
-                confidence = base_confidence + (lang_ratio * 0.2)
-            else:
-                confidence = base_confidence
-        else:
-            confidence = base_confidence * 0.7
-        
-        return min(1.0, max(0.1, confidence))
+        return self._confidence_from_features(self.extract_features(text), detected_lang)
+
+# =====================================
+# PARALLEL TEXT ANALYSIS
+# =====================================
+
+_analysis_pool = None
+_analysis_pool_lock = threading.Lock()
+_worker_text_processor = None  # Trong tiến trình con của pool
+
+def _init_analysis_worker():
+    """Khởi tạo tiến trình con: giữ 1 EnhancedTextProcessor (regex + lexicon đã biên dịch) cho mọi shard"""
+    global _worker_text_processor
+    _worker_text_processor = EnhancedTextProcessor()
+    _worker_text_processor.create_style_analysis_json("Xin chào. こんにちは。", parallel=False)
+
+def _analyze_shard(args) -> List[Dict]:
+    text, voice_mappings = args
+    return _worker_text_processor.create_style_analysis_json(text, voice_mappings, parallel=False)
+
+def get_analysis_pool() -> ProcessPoolExecutor:
+    global _analysis_pool
+    with _analysis_pool_lock:
+        if _analysis_pool is None:
+            # spawn: không fork tiến trình Qt đang chạy nhiều thread
+            _analysis_pool = ProcessPoolExecutor(
+                max_workers=ANALYSIS_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_analysis_worker
+            )
+        return _analysis_pool
+
+def prewarm_analysis_pool():
+    """Khởi động sẵn các tiến trình con (import + biên dịch regex) trong lúc chờ việc khác"""
+    pool = get_analysis_pool()
+    for _ in range(ANALYSIS_WORKERS):
+        pool.submit(_analyze_shard, ("", None))
+
+def shutdown_analysis_pool():
+    global _analysis_pool
+    with _analysis_pool_lock:
+        if _analysis_pool is not None:
+            _analysis_pool.shutdown(wait=False, cancel_futures=True)
+            _analysis_pool = None
+
+
+def estimate_tokens(text: str) -> int:
+    """Ước lượng số token: CJK ~1 token/ký tự, còn lại ~4 ký tự/token"""
+    if not text:
+        return 0
+    cjk = len(re.findall(r'[\u3040-\u30ff\u4e00-\u9fff\uff00-\uffef]', text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+# Cách chia 1 đơn vị còn quá max_tokens, lần lượt: dòng -> câu -> mệnh đề -> khoảng trắng (-> cắt cứng)
+_SEGMENT_SPLITS = [
+    (re.compile(r'\n'), "\n"),
+    (re.compile(r'(?<=[.!?。！？])\s*'), " "),
+    (re.compile(r'(?<=[,;:、，；])\s*'), " "),
+    (re.compile(r'\s+'), " "),
+]
+
+def _segment_units(text: str, max_tokens: int, separator: str, level: int = 0) -> List[Tuple[str, str]]:
+    """(đơn vị, ký tự nối với đơn vị trước) - mỗi đơn vị <= max_tokens"""
+    if estimate_tokens(text) <= max_tokens:
+        return [(text, separator)]
+    if level == len(_SEGMENT_SPLITS):
+        # Không còn ranh giới nào (vd tiếng Nhật không dấu câu): mỗi ký tự <= 1 token
+        return [(text[j:j + max_tokens], separator if j == 0 else "") for j in range(0, len(text), max_tokens)]
+    
+    pattern, piece_separator = _SEGMENT_SPLITS[level]
+    units = []
+    for piece in pattern.split(text):
+        piece = piece.strip()
+        if piece:
+            units.extend(_segment_units(piece, max_tokens, piece_separator if units else separator, level + 1))
+    return units
+
+
+def split_text_segments(text: str, max_tokens: int = LONG_REWRITE_SEGMENT_TOKENS) -> List[str]:
+    """Chia văn bản theo đoạn văn thành các phân đoạn <= max_tokens (đoạn văn quá dài -> chia nhỏ dần)"""
+    max_tokens = max(1, max_tokens)
+    units = []
+    for paragraph in re.split(r'\n\s*\n', text):
+        paragraph = paragraph.strip()
+        if paragraph:
+            units.extend(_segment_units(paragraph, max_tokens, "\n\n"))
+    
+    segments = []
+    current = ""
+    current_tokens = 0
+    for unit, separator in units:
+        # Ước lượng từng phần >= ước lượng cả chuỗi nên tổng (kể cả ký tự nối) không vượt max_tokens
+        unit_tokens = estimate_tokens(unit)
+        separator_tokens = estimate_tokens(separator) if current else 0
+        if current and current_tokens + separator_tokens + unit_tokens > max_tokens:
+            segments.append(current)
+            current, current_tokens, separator_tokens = "", 0, 0
+        current = f"{current}{separator}{unit}" if current else unit
+        current_tokens += separator_tokens + unit_tokens
+    if current:
+        segments.append(current)
+    return segments
+
+
+def generation_config_for(text: str) -> dict:
+    """Generation config với maxOutputTokens theo kích thước đầu vào (không thấp hơn mặc định)"""
+    max_tokens = max(DEFAULT_GENERATION_CONFIG["maxOutputTokens"],
+                     estimate_tokens(text) * REWRITE_OUTPUT_FACTOR)
+    return {**DEFAULT_GENERATION_CONFIG, "maxOutputTokens": min(MAX_OUTPUT_TOKENS_CAP, max_tokens)}
+
+
+class StreamingSentenceAnalyzer:
+    """THÊM: Phân tích từng câu ngay khi câu hoàn chỉnh trong luồng text.
+    
+    sentence_split chỉ cắt tại dấu kết câu nên phân tích phần đã kết thúc bằng dấu câu
+    cho kết quả giống hệt phân tích toàn bộ văn bản.
+    """
+    
+    SENTENCE_END = re.compile(r'[.!?。！？]')
+    
+    def __init__(self, text_processor: 'EnhancedTextProcessor', voice_mappings: dict = None):
+        self.text_processor = text_processor
+        self.voice_mappings = voice_mappings
+        self.pending = ""
+        self.analysis = []
+    
+    def _analyze(self, text: str) -> List[Dict]:
+        entries = self.text_processor.create_style_analysis_json(text, self.voice_mappings)
+        self.analysis.extend(entries)
+        return entries
+    
+    def feed(self, delta: str) -> List[Dict]:
+        """Thêm text mới, trả về phân tích của các câu vừa hoàn chỉnh"""
+        self.pending += delta
+        last_end = None
+        for last_end in self.SENTENCE_END.finditer(self.pending):
+            pass
+        if last_end is None:
+            return []
+        complete = self.pending[:last_end.end()]
+        self.pending = self.pending[last_end.end():]
+        return self._analyze(complete)
+    
+    def finish(self) -> List[Dict]:
+        """Phân tích phần còn lại (câu cuối không có dấu kết câu)"""
+        rest, self.pending = self.pending, ""
+        return self._analyze(rest)
 
 # =====================================
 # JAPANESE HIGHLIGHTER
@@ -591,6 +1678,206 @@ def check_expiration():
     except Exception:
         return True
 
+# =====================================
+# RATE LIMITER
+# =====================================
+
+class TokenBucket:
+    """Token bucket cho 1 key: nạp lại theo RPM, chặn tạm thời khi bị 429"""
+    
+    def __init__(self, rpm: float, capacity: float = 1.0):
+        self.lock = threading.Lock()
+        self.rpm = 0.0
+        self.rate = 0.0
+        self.capacity = max(1.0, float(capacity))
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.blocked_until = 0.0
+        self.set_rpm(rpm)
+    
+    def set_rpm(self, rpm: float):
+        with self.lock:
+            rpm = max(0.0, float(rpm or 0))
+            if rpm != self.rpm:
+                self._refill(time.time())
+                self.rpm = rpm
+                self.rate = rpm / 60.0
+    
+    def _refill(self, now: float):
+        if now > self.updated:
+            if self.rate > 0:
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+    
+    def time_until_available(self, now: float = None) -> float:
+        """Số giây đến khi lấy được 1 token (0 = dùng được ngay)"""
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self._refill(now)
+            wait_time = max(0.0, self.blocked_until - now)
+            if self.rate > 0 and self.tokens < 1.0:
+                wait_time = max(wait_time, (1.0 - self.tokens) / self.rate)
+            return wait_time
+    
+    def try_acquire(self, now: float = None) -> bool:
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self._refill(now)
+            if now < self.blocked_until:
+                return False
+            if self.rate <= 0:
+                return True  # rpm = 0: không giới hạn
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                return True
+            return False
+    
+    def blocked_for(self, now: float = None) -> float:
+        """Số giây còn bị chặn do 429 (không tính pacing)"""
+        if now is None:
+            now = time.time()
+        return max(0.0, self.blocked_until - now)
+    
+    def block(self, seconds: float, now: float = None):
+        """Chặn bucket trong `seconds` giây (Retry-After / cooldown)"""
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, now + max(0.0, seconds))
+            self.tokens = 0.0
+            self.updated = max(self.updated, now)
+
+
+class KeyScheduler:
+    """Heap theo thời điểm key được dùng tiếp - O(log n) mỗi lần chọn key
+    
+    Key sẵn sàng lâu nhất được chọn trước, key vừa dùng xếp lại phía sau
+    => round-robin công bằng giữa các key sẵn sàng. Entry cũ bị bỏ lazy.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._heap = []      # (ready_at, seq, key)
+        self._entries = {}   # key -> seq của entry hợp lệ (None = đang được dùng)
+        self._seq = itertools.count()
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def __contains__(self, key):
+        return key in self._entries
+    
+    def _push(self, key, ready_at):
+        seq = next(self._seq)
+        self._entries[key] = seq
+        heapq.heappush(self._heap, (ready_at, seq, key))
+        # Dọn entry cũ khi heap phình quá lớn
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [e for e in self._heap if self._entries.get(e[2]) == e[1]]
+            heapq.heapify(self._heap)
+    
+    def _discard_stale(self):
+        heap = self._heap
+        while heap and self._entries.get(heap[0][2]) != heap[0][1]:
+            heapq.heappop(heap)
+    
+    def add(self, key, ready_at=0.0):
+        with self.lock:
+            self._push(key, ready_at)
+    
+    def remove(self, key):
+        with self.lock:
+            self._entries.pop(key, None)
+    
+    def clear(self):
+        with self.lock:
+            self._heap.clear()
+            self._entries.clear()
+    
+    def reschedule(self, key, ready_at):
+        """Đặt lại thời điểm key dùng được (bỏ qua nếu key đã bị xóa)"""
+        with self.lock:
+            if key in self._entries:
+                self._push(key, ready_at)
+    
+    def peek(self):
+        """(ready_at, key) của key sớm nhất, None nếu rỗng"""
+        with self.lock:
+            self._discard_stale()
+            if not self._heap:
+                return None
+            ready_at, _, key = self._heap[0]
+            return ready_at, key
+    
+    def pop_ready(self, now):
+        """Lấy key sẵn sàng sớm nhất; caller phải reschedule() lại sau khi dùng"""
+        with self.lock:
+            self._discard_stale()
+            if not self._heap or self._heap[0][0] > now:
+                return None
+            _, _, key = heapq.heappop(self._heap)
+            self._entries[key] = None
+            return key
+
+
+def parse_retry_after(value) -> Optional[float]:
+    """Parse header Retry-After (số giây hoặc HTTP-date) -> số giây"""
+    if value is None:
+        return None
+    value = str(value).strip()
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        from email.utils import parsedate_to_datetime
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except Exception:
+        return None
+
+
+_quota_timezone = None
+
+def get_quota_timezone():
+    global _quota_timezone
+    if _quota_timezone is None:
+        try:
+            from zoneinfo import ZoneInfo
+            _quota_timezone = ZoneInfo(QUOTA_RESET_TIMEZONE)
+        except Exception:
+            # Không có tzdata (vd. Windows) -> dùng PST cố định
+            _quota_timezone = datetime.timezone(datetime.timedelta(hours=-8))
+    return _quota_timezone
+
+def next_quota_reset(now: float = None) -> float:
+    """Timestamp lần reset quota ngày tiếp theo"""
+    if now is None:
+        now = time.time()
+    local = datetime.datetime.fromtimestamp(now, get_quota_timezone())
+    next_day = (local + datetime.timedelta(days=1)).date()
+    midnight = datetime.datetime.combine(next_day, datetime.time(0), tzinfo=local.tzinfo)
+    return midnight.timestamp()
+
+_DAILY_QUOTA_REGEX = re.compile(r'per[ _-]?day|PerDay', re.IGNORECASE)
+
+def is_daily_quota_error(error_text) -> bool:
+    """429 do hết quota ngày (quotaId ...PerDay...) thay vì giới hạn theo phút"""
+    return bool(error_text) and bool(_DAILY_QUOTA_REGEX.search(str(error_text)))
+
+_RETRY_DELAY_REGEX = re.compile(r'retryDelay[\'"]?\s*[:=]\s*[\'"]?(\d+(?:\.\d+)?)s')
+
+def parse_retry_delay(error_text) -> Optional[float]:
+    """Lấy RetryInfo.retryDelay ("37s") trong body lỗi của Gemini"""
+    if not error_text:
+        return None
+    match = _RETRY_DELAY_REGEX.search(str(error_text))
+    return float(match.group(1)) if match else None
+
 # =====================================
 # GEMINI API MANAGER - ĐÃ SỬA
 # =====================================
@@ -598,15 +1885,46 @@ def check_expiration():
 class GeminiAPIManager:
     """Enhanced API Manager - AUTO FALLBACK & EXTENDED COOLDOWN"""
     
-    def __init__(self):
+    def __init__(self, http_pool_size=DEFAULT_HTTP_POOL_SIZE, base_url=None, persist=True):
+        # THÊM: persist=False -> không đọc/ghi key, state, cache model (load test, benchmark)
+        self.persist = persist
+        # THÊM: Endpoint có thể đổi (mock server / proxy), base_url là gốc không kèm /v1beta
+        self.api_root = (base_url or GEMINI_API_ROOT).rstrip("/")
+        self.base_url = f"{self.api_root}/{GEMINI_API_VERSION}"
+        # THÊM: Lock chung cho keys/stats/limiter/scheduler - manager được dùng
+        # đồng thời bởi RewriteWorker, SmartTTSWorkerV6 và thread test keys
+        self._lock = threading.RLock()
         self.api_keys = []
         self.usage_stats = {}
-        self.current_key_index = 0
         self.default_model = DEFAULT_TEXT_MODEL
         self.logger = logging.getLogger(__name__)
         self.max_retries = 2  # Giảm retry để nhanh hơn
-        self.rate_limit_cooldown = 120  # TĂNG: 2 phút cooldown
-        self.load_saved_api_keys()
+        self.rate_limit_cooldown = 60  # Cooldown khi 429 mà server không gửi Retry-After
+        
+        # THÊM: Token bucket theo key, trần RPM/RPD tùy chọn theo model (RATE_LIMITS_FILE)
+        self.tts_model = DEFAULT_TTS_MODEL
+        self.model_rate_limits = (load_rate_limits() if persist
+                                  else {m: dict(v) for m, v in MODEL_RATE_LIMITS.items()})
+        self.rate_limiters = {}
+        self.schedulers = {}  # model -> KeyScheduler
+        self.max_key_wait = 30  # Chờ tối đa (giây) khi mọi key đang pacing
+        
+        # THÊM: Session dùng chung, giữ kết nối TCP/TLS giữa các request
+        self.http_pool_size = max(1, int(http_pool_size))
+        self._http_session = None
+        self._http_session_lock = threading.Lock()
+        
+        # THÊM: Cache genai.Client theo key (tái sử dụng client + HTTP transport)
+        self._genai_clients = {}
+        self._genai_clients_lock = threading.Lock()
+        
+        # THÊM: Ghi state theo lô (dirty flag + timer), nạp lại khi khởi động
+        self._state_dirty = False
+        self._state_timer = None
+        self._state_io_lock = threading.Lock()  # Tuần tự hóa ghi state + cache model
+        
+        if self.persist:
+            self.load_saved_api_keys()
         
         # THÊM: Model fallback sequence
         self.model_fallback_sequence = [
@@ -615,40 +1933,150 @@ class GeminiAPIManager:
             "gemini-1.5-pro-002",
         ]
         
+        # THÊM: Cache model khả dụng, lưu qua các lần chạy
+        self.model_cache_ttl = MODEL_CACHE_TTL
+        # model -> {"available", "checked_at"}
+        self.model_availability, self._models_listed_at = load_model_cache() if self.persist else ({}, 0)
+        self._models_list_retry_at = 0
+        self._models_refresh_lock = threading.Lock()  # single-flight cho models.list
+        
+    def get_http_session(self):
+        """Session keep-alive dùng chung (tạo lazy, thread-safe)"""
+        if self._http_session is None:
+            with self._http_session_lock:
+                if self._http_session is None:
+                    session = requests.Session()
+                    # Không retry ở tầng transport - retry/fallback do manager xử lý
+                    adapter = HTTPAdapter(
+                        pool_connections=1,
+                        pool_maxsize=self.http_pool_size,
+                        max_retries=0,
+                    )
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self._http_session = session
+        return self._http_session
+    
+    def get_genai_client(self, api_key):
+        """genai.Client cho key (tạo lazy, dùng lại cho các chunk sau)"""
+        with self._genai_clients_lock:
+            client = self._genai_clients.get(api_key)
+            if client is None:
+                if self.api_root != DEFAULT_GEMINI_API_ROOT:
+                    client = genai.Client(
+                        api_key=api_key,
+                        http_options=genai_types.HttpOptions(base_url=self.api_root + "/"),
+                    )
+                else:
+                    client = genai.Client(api_key=api_key)
+                self._genai_clients[api_key] = client
+            return client
+    
+    def evict_genai_clients(self, api_keys=None):
+        """Xóa client khỏi cache (mặc định: tất cả)"""
+        with self._genai_clients_lock:
+            keys = list(self._genai_clients) if api_keys is None else list(api_keys)
+            clients = [self._genai_clients.pop(k) for k in keys if k in self._genai_clients]
+        
+        for client in clients:
+            close = getattr(client, 'close', None)
+            if callable(close):
+                try:
+                    close()
+                except Exception:
+                    pass
+    
+    def close(self):
+        """Đóng các kết nối đang giữ trong pool"""
+        self.flush_state()
+        with self._http_session_lock:
+            if self._http_session is not None:
+                self._http_session.close()
+                self._http_session = None
+        self.evict_genai_clients()
+    
+    @staticmethod
+    def _new_usage_stats(with_models=True):
+        stats = {
+            "calls": 0, 
+            "errors": 0, 
+            "rate_limits": 0,
+            "last_used": 0, 
+            "last_error": None,
+            "last_rate_limit": 0,
+            "successful_calls": 0  # THÊM
+        }
+        if with_models:
+            stats["models"] = {}  # THÊM: stats theo từng model
+        else:
+            # THÊM: đếm request trong ngày quota hiện tại
+            stats["daily_calls"] = 0
+            stats["daily_reset_at"] = 0
+            stats["daily_exhausted"] = False
+        return stats
+    
+    @staticmethod
+    def _roll_daily_quota(model_stats, now):
+        """Reset bộ đếm ngày nếu đã qua mốc reset của provider"""
+        if now >= model_stats.get("daily_reset_at", 0):
+            model_stats["daily_calls"] = 0
+            model_stats["daily_exhausted"] = False
+            model_stats["daily_reset_at"] = next_quota_reset(now)
+    
+    @staticmethod
+    def _daily_remaining(model_stats, rpd):
+        """Số request còn lại trong ngày (None = không giới hạn)"""
+        if model_stats.get("daily_exhausted"):
+            return 0
+        if not rpd:
+            return None
+        return max(0, rpd - model_stats.get("daily_calls", 0))
+    
+    def get_model_stats(self, api_key, model=None):
+        """Stats của cặp (key, model) - quota Gemini tính riêng cho mỗi model"""
+        with self._lock:
+            models = self.usage_stats[api_key].setdefault("models", {})
+            model = model or self.default_model
+            if model not in models:
+                models[model] = self._new_usage_stats(with_models=False)
+            return models[model]
+    
+    def get_api_keys(self):
+        """Snapshot danh sách key (an toàn khi thread khác thêm/xóa key)"""
+        with self._lock:
+            return list(self.api_keys)
+    
+    def set_default_model(self, model):
+        with self._lock:
+            self.default_model = model
+    
     def add_api_key(self, api_key):
         if not api_key or not isinstance(api_key, str):
             return False
         api_key = api_key.strip()
         if len(api_key) < 20:
             return False
-        if api_key not in self.api_keys:
+        with self._lock:
+            if api_key in self.api_keys:
+                return False
             self.api_keys.append(api_key)
-            self.usage_stats[api_key] = {
-                "calls": 0, 
-                "errors": 0, 
-                "rate_limits": 0,
-                "last_used": 0, 
-                "last_error": None,
-                "last_rate_limit": 0,
-                "successful_calls": 0  # THÊM
-            }
-            self.save_current_api_keys()
-            return True
-        return False
+            self.usage_stats[api_key] = self._new_usage_stats()
+            self._schedule_new_key(api_key)
+        self.save_current_api_keys()
+        return True
     
     def load_saved_api_keys(self):
         try:
             saved_keys = load_api_keys()
-            for key in saved_keys:
-                if key not in self.api_keys:
-                    self.api_keys.append(key)
-                    self.usage_stats[key] = {
-                        "calls": 0, "errors": 0, "rate_limits": 0,
-                        "last_used": 0, "last_error": None, 
-                        "last_rate_limit": 0, "successful_calls": 0
-                    }
+            with self._lock:
+                for key in saved_keys:
+                    if key not in self.api_keys:
+                        self.api_keys.append(key)
+                        self.usage_stats[key] = self._new_usage_stats()
+                        self._schedule_new_key(key)
             
             if saved_keys:
+                self.restore_state(load_api_state())
                 self.logger.info(f"Loaded {len(saved_keys)} keys")
                 return True
         except Exception as e:
@@ -656,83 +2084,404 @@ class GeminiAPIManager:
         return False
     
     def save_current_api_keys(self):
+        if not self.persist:
+            return False
         try:
-            if self.api_keys:
-                return save_api_keys(self.api_keys)
+            api_keys = self.get_api_keys()
+            if api_keys:
+                return save_api_keys(api_keys)
         except Exception as e:
             self.logger.warning(f"Save keys error: {e}")
         return False
     
     def clear_all_api_keys(self):
         try:
-            self.api_keys.clear()
-            self.usage_stats.clear()
-            self.current_key_index = 0
-            clear_saved_api_keys()
+            with self._lock:
+                self.api_keys.clear()
+                self.usage_stats.clear()
+                self.rate_limiters.clear()
+                self.schedulers.clear()
+                self._state_dirty = False
+            self.evict_genai_clients()
+            if self.persist:
+                clear_saved_api_keys()
             return True
         except Exception as e:
             return False
     
+    # ======= PERSISTED STATE =======
+    
+    @staticmethod
+    def _persistable_stats(stats):
+        """Bản sao stats bỏ last_error (cả stats theo model) - chỉ lưu bộ đếm/deadline"""
+        clean = {k: copy.deepcopy(v) for k, v in stats.items() if k not in ("last_error", "models")}
+        if "models" in stats:
+            clean["models"] = {
+                model: {k: v for k, v in model_stats.items() if k != "last_error"}
+                for model, model_stats in stats["models"].items()
+            }
+        return clean
+    
+    def export_state(self):
+        """Snapshot stats + cooldown deadline theo key fingerprint (không lưu last_error)"""
+        now = time.time()
+        with self._lock:
+            cooldowns = {}
+            for (key, model), limiter in self.rate_limiters.items():
+                if limiter.blocked_until > now:
+                    cooldowns.setdefault(key, {})[model] = limiter.blocked_until
+            
+            return {
+                api_key_fingerprint(key): {
+                    "usage_stats": self._persistable_stats(self.usage_stats[key]),
+                    "cooldown_until": cooldowns.get(key, {}),
+                }
+                for key in self.api_keys
+            }
+    
+    def restore_state(self, keys_state):
+        """Nạp lại state đã lưu cho các key hiện có"""
+        if not keys_state:
+            return 0
+        
+        restored = 0
+        now = time.time()
+        with self._lock:
+            for key in self.api_keys:
+                saved = keys_state.get(api_key_fingerprint(key))
+                if not saved:
+                    continue
+                
+                stats = self._new_usage_stats()
+                stats.update(self._persistable_stats(saved.get("usage_stats", {})))  # file state cũ có thể chứa last_error
+                self.usage_stats[key] = stats
+                
+                for model, blocked_until in saved.get("cooldown_until", {}).items():
+                    if blocked_until > now:
+                        self.get_rate_limiter(key, model).block(blocked_until - now, now)
+                        scheduler = self.schedulers.get(model)
+                        if scheduler is not None:
+                            scheduler.reschedule(key, blocked_until)
+                restored += 1
+        
+        if restored:
+            self.logger.info(f"Restored state cho {restored} keys")
+        return restored
+    
+    def mark_state_dirty(self):
+        """Đánh dấu state thay đổi - ghi gộp sau API_STATE_FLUSH_INTERVAL giây"""
+        if not self.persist:
+            return
+        with self._lock:
+            self._state_dirty = True
+            if self._state_timer is None:
+                self._state_timer = threading.Timer(API_STATE_FLUSH_INTERVAL, self.flush_state)
+                self._state_timer.daemon = True
+                self._state_timer.start()
+    
+    def flush_state(self):
+        """Ghi state ngay nếu có thay đổi"""
+        # Lock I/O ngoài cùng (luôn lấy trước self._lock): bản chụp cũ không ghi đè bản mới hơn
+        with self._state_io_lock:
+            with self._lock:
+                if self._state_timer is not None:
+                    self._state_timer.cancel()
+                    self._state_timer = None
+                if not self._state_dirty:
+                    return True
+                self._state_dirty = False
+                keys_state = self.export_state()
+            
+            return save_api_state(keys_state)
+    
     def add_multiple_keys(self, keys_text):
         if not keys_text:
             return 0
         keys = [key.strip() for key in keys_text.split('\n') if key.strip()]
         return sum(1 for key in keys if self.add_api_key(key))
     
-    def get_next_available_key(self):
-        """Get next available key với extended cooldown"""
+    def get_model_rate_limit(self, model=None):
+        """RPM/RPD cấu hình cho model"""
+        return self.model_rate_limits.get(model or self.default_model, DEFAULT_RATE_LIMIT)
+    
+    def set_model_rate_limit(self, model, rpm=None, rpd=None):
+        with self._lock:
+            limits = dict(self.get_model_rate_limit(model))
+            if rpm is not None:
+                limits["rpm"] = rpm
+                for (key, limiter_model), limiter in self.rate_limiters.items():
+                    if limiter_model == model:
+                        limiter.set_rpm(rpm)
+                # Lịch cũ tính theo RPM cũ -> dựng lại lazy
+                self.schedulers.pop(model, None)
+            if rpd is not None:
+                limits["rpd"] = rpd
+            self.model_rate_limits[model] = limits
+            if self.persist:
+                save_rate_limits(self.model_rate_limits)
+    
+    def get_rate_limiter(self, api_key, model=None):
+        """Token bucket của cặp (key, model), tốc độ nạp theo RPM của model"""
+        model = model or self.default_model
+        limiter = self.rate_limiters.get((api_key, model))
+        if limiter is None:
+            with self._lock:
+                limiter = self.rate_limiters.get((api_key, model))
+                if limiter is None:
+                    rpm = self.get_model_rate_limit(model)["rpm"]
+                    limiter = TokenBucket(rpm)
+                    self.rate_limiters[(api_key, model)] = limiter
+        return limiter
+    
+    def get_scheduler(self, model=None):
+        """KeyScheduler của model (tạo lazy từ trạng thái token bucket)"""
+        model = model or self.default_model
+        scheduler = self.schedulers.get(model)
+        if scheduler is None:
+            with self._lock:
+                scheduler = self.schedulers.get(model)
+                if scheduler is None:
+                    scheduler = KeyScheduler()
+                    now = time.time()
+                    for key in self.api_keys:
+                        wait_time = self.get_rate_limiter(key, model).time_until_available(now)
+                        scheduler.add(key, now + wait_time)
+                    self.schedulers[model] = scheduler
+        return scheduler
+    
+    def _schedule_new_key(self, api_key):
+        with self._lock:
+            schedulers = list(self.schedulers.values())
+        for scheduler in schedulers:
+            scheduler.add(api_key, 0.0)
+    
+    def get_next_available_key(self, model=None):
+        """Get next available key - heap scheduler + token bucket"""
         if not self.api_keys:
             return None
         
-        current_time = time.time()
-        available_keys = []
-        
-        for key in self.api_keys:
-            stats = self.usage_stats[key]
-            time_since_limit = current_time - stats.get('last_rate_limit', 0)
-            
-            # Key available nếu chưa bị limit hoặc đã qua cooldown period
-            if time_since_limit > self.rate_limit_cooldown or stats.get('last_rate_limit', 0) == 0:
-                available_keys.append(key)
-        
-        if not available_keys:
-            self.logger.error("❌ ALL KEYS RATE LIMITED!")
-            return None
-        
-        # Rotate qua available keys
-        self.current_key_index = (self.current_key_index + 1) % len(available_keys)
-        selected = available_keys[self.current_key_index]
+        model = model or self.default_model
+        scheduler = self.get_scheduler(model)
+        current_time = time.time()
         
-        self.logger.info(f"Selected ...{selected[-8:]} ({len(available_keys)}/{len(self.api_keys)} available)")
-        return selected
+        while True:
+            key = scheduler.pop_ready(current_time)
+            if key is None:
+                self.logger.debug("⏳ Tất cả keys đang chờ rate limit")
+                return None
+            
+            # Key đã ra khỏi heap: luôn xếp lại (kể cả khi limiter lỗi), nếu không sẽ mất khỏi scheduler
+            acquired = False
+            ready_at = current_time + 0.001  # tránh lấy lại key này trong vòng lặp
+            try:
+                limiter = self.get_rate_limiter(key, model)
+                acquired = limiter.try_acquire(current_time)
+                # Xếp lại key theo thời điểm có token tiếp theo
+                wait_time = limiter.time_until_available(current_time)
+                if not acquired:
+                    wait_time = max(wait_time, 0.001)
+                ready_at = current_time + wait_time
+            finally:
+                scheduler.reschedule(key, ready_at)
+            
+            if acquired:
+                self.logger.info(f"Selected ...{key[-8:]} ({model})")
+                return key
+    
+    def acquire_api_key(self, model=None, max_wait=None):
+        """Lấy key, chờ pacing nếu key sớm nhất sẵn sàng trong max_wait giây"""
+        if max_wait is None:
+            max_wait = self.max_key_wait
+        deadline = time.time() + max_wait
+        
+        while True:
+            api_key = self.get_next_available_key(model)
+            if api_key or not self.api_keys:
+                return api_key
+            
+            wait_time = self._get_wait_time(model)
+            if time.time() + wait_time > deadline:
+                return None
+            time.sleep(min(max(wait_time, 0.05), 1.0))
     
     def get_best_api_key(self):
         return self.get_next_available_key()
     
-    def update_usage(self, api_key, success=True, error_msg=None, is_rate_limit=False):
-        if api_key in self.usage_stats:
-            stats = self.usage_stats[api_key]
-            stats["calls"] += 1
-            stats["last_used"] = time.time()
-            
-            if success:
-                stats["successful_calls"] += 1
-            else:
-                stats["errors"] += 1
-                stats["last_error"] = error_msg
+    def update_usage(self, api_key, success=True, error_msg=None, is_rate_limit=False, retry_after=None, model=None,
+                     daily_quota=False, status_code=None):
+        # THÊM: Chỉ request server đã nhận xử lý (thành công hoặc 4xx khác 429) mới tính vào quota ngày;
+        # 429, 5xx và lỗi mạng không tính
+        accepted = success or (status_code is not None and 200 <= status_code < 500 and status_code != 429)
+        with self._lock:
+            if api_key not in self.usage_stats:
+                return
+            model = model or self.default_model
+            now = time.time()
+            self.mark_state_dirty()
+            for stats in (self.usage_stats[api_key], self.get_model_stats(api_key, model)):
+                stats["calls"] += 1
+                stats["last_used"] = now
                 
-                if is_rate_limit:
-                    stats["rate_limits"] += 1
-                    stats["last_rate_limit"] = time.time()
-                    self.logger.warning(f"Key ...{api_key[-8:]} rate limited ({stats['rate_limits']} times)")
+                if success:
+                    stats["successful_calls"] += 1
+                else:
+                    stats["errors"] += 1
+                    stats["last_error"] = _redact(error_msg)
+                    
+                    if is_rate_limit:
+                        stats["rate_limits"] += 1
+                        stats["last_rate_limit"] = now
+            
+            # Quota ngày theo (key, model)
+            model_stats = self.get_model_stats(api_key, model)
+            self._roll_daily_quota(model_stats, now)
+            if accepted:
+                model_stats["daily_calls"] += 1
+            # Hết quota ngày: 429 báo rõ quota ngày, hoặc chạm trần RPD đã cấu hình
+            rpd = self.get_model_rate_limit(model).get("rpd")
+            if (daily_quota and is_rate_limit) or (rpd and accepted and model_stats["daily_calls"] >= rpd):
+                if not model_stats["daily_exhausted"]:
+                    model_stats["daily_exhausted"] = True
+                    reset_at = model_stats["daily_reset_at"]
+                    self.get_rate_limiter(api_key, model).block(reset_at - now, now)
+                    self.get_scheduler(model).reschedule(api_key, reset_at)
+                    self.logger.warning(
+                        f"Key ...{api_key[-8:]} hết quota ngày trên {model}, "
+                        f"reset sau {int(reset_at - now) // 60} phút"
+                    )
+                return
+            
+            if not success and is_rate_limit:
+                # Chỉ chặn model bị 429, key vẫn dùng được cho model khác
+                cooldown = retry_after if retry_after is not None else self.rate_limit_cooldown
+                limiter = self.get_rate_limiter(api_key, model)
+                limiter.block(cooldown, now)
+                self.get_scheduler(model).reschedule(api_key, now + limiter.time_until_available(now))
+                self.logger.warning(
+                    f"Key ...{api_key[-8:]} rate limited trên {model} "
+                    f"({self.get_model_stats(api_key, model)['rate_limits']} times), chờ {cooldown:.0f}s"
+                )
+    
+    # ======= MODEL AVAILABILITY CACHE =======
+    
+    def is_model_available(self, model):
+        """True/False theo cache, None nếu chưa biết hoặc đã hết hạn"""
+        with self._lock:
+            entry = self.model_availability.get(model)
+        if not entry or time.time() - entry.get("checked_at", 0) > self.model_cache_ttl:
+            return None
+        return entry.get("available")
+    
+    def set_model_available(self, model, available):
+        """Cập nhật cache; chỉ ghi file khi trạng thái thay đổi"""
+        with self._lock:
+            entry = self.model_availability.get(model)
+            changed = not entry or entry.get("available") != available
+            fresh = entry and time.time() - entry.get("checked_at", 0) < self.model_cache_ttl / 2
+            if not changed and fresh:
+                return
+            self.model_availability[model] = {"available": available, "checked_at": time.time()}
+        self._save_model_cache()
+    
+    def _save_model_cache(self):
+        if not self.persist:
+            return
+        # Chụp + ghi trong cùng lock I/O: bản chụp cũ không ghi đè bản mới hơn
+        with self._state_io_lock:
+            with self._lock:
+                models = dict(self.model_availability)
+                listed_at = self._models_listed_at
+            save_model_cache(models, listed_at)
+    
+    def _models_list_fresh(self, now):
+        return (now - self._models_listed_at < self.model_cache_ttl
+                or now < self._models_list_retry_at)
+    
+    def refresh_model_availability(self, api_key=None, force=False):
+        """Nạp danh sách model bằng models.list (đủ mọi trang); chỉ 1 thread gọi, thread khác chờ kết quả"""
+        requested_at = time.time()
+        if not force and self._models_list_fresh(requested_at):
+            return True
+        
+        with self._models_refresh_lock:
+            now = time.time()
+            # Thread khác vừa nạp xong trong lúc chờ lock
+            if self._models_listed_at >= requested_at or (not force and self._models_list_fresh(now)):
+                return True
+            # Lỗi thì không thử lại ngay ở request kế tiếp
+            self._models_list_retry_at = now + 300
+            
+            api_key = api_key or next(iter(self.get_api_keys()), None)
+            if not api_key:
+                return False
+            
+            listed = set()
+            page_token = None
+            try:
+                for _ in range(MODELS_LIST_MAX_PAGES):
+                    params = {"pageSize": 1000}
+                    if page_token:
+                        params["pageToken"] = page_token
+                    response = self.get_http_session().get(f"{self.base_url}/models", params=params,
+                                                           headers={"x-goog-api-key": api_key}, timeout=15)
+                    if response.status_code != 200:
+                        self.logger.warning(f"models.list: HTTP {response.status_code}")
+                        return False
+                    
+                    data = response.json()
+                    for item in data.get("models", []):
+                        name = item.get("name", "").split("/")[-1]
+                        if "generateContent" in item.get("supportedGenerationMethods", ["generateContent"]):
+                            listed.add(name)
+                    page_token = data.get("nextPageToken")
+                    if not page_token:
+                        break
+                else:
+                    # Danh sách chưa đủ -> không được suy ra model nào không khả dụng
+                    self.logger.warning(f"models.list: quá {MODELS_LIST_MAX_PAGES} trang, bỏ qua")
+                    return False
+            except Exception as e:
+                self.logger.warning(f"models.list error: {e}")
+                return False
+            
+            now = time.time()
+            with self._lock:
+                known = set(GEMINI_MODELS) | set(self.model_fallback_sequence) | set(self.model_availability)
+                known.add(self.default_model)
+                for model in known | listed:
+                    # Model TTS đang cấu hình chỉ bị đánh dấu chết khi gọi thật trả 404
+                    if model not in listed and model == self.tts_model:
+                        continue
+                    self.model_availability[model] = {"available": model in listed, "checked_at": now}
+                self._models_listed_at = now
+        self._save_model_cache()
+        self.logger.info(f"📋 models.list: {len(listed)} models khả dụng")
+        return True
     
-    def try_model_with_fallback(self, prompt, model=None, api_key=None):
+    def resolve_model(self, model=None):
+        """Model đầu tiên chưa bị đánh dấu không khả dụng (model -> fallback)"""
+        model = model or self.default_model
+        if self.is_model_available(model) is not False:
+            return model
+        
+        candidates = [m for m in self.model_fallback_sequence if m != model]
+        candidates += [m for m in GEMINI_MODELS if m not in candidates and "tts" not in m]
+        # Ưu tiên model đã biết chắc còn sống, sau đó đến model chưa biết
+        for wanted in (True, None):
+            for candidate in candidates:
+                if self.is_model_available(candidate) is wanted:
+                    self.logger.info(f"⏭️ Bỏ qua model '{model}' (cache: không khả dụng) -> {candidate}")
+                    return candidate
+        return model
+    
+    def try_model_with_fallback(self, prompt, model=None, api_key=None, generation_config=None):
         """THÊM: Try model, fallback nếu 404"""
         if model is None:
             model = self.default_model
+        model = self.resolve_model(model)
         
         # Try primary model
-        result = self._try_single_model(prompt, model, api_key)
+        result = self._try_single_model(prompt, model, api_key, generation_config)
         
         # Nếu 404, try fallback models
         if result.get("error") and "not found" in result["error"].lower():
@@ -741,13 +2490,15 @@ class GeminiAPIManager:
             for fallback_model in self.model_fallback_sequence:
                 if fallback_model == model:
                     continue  # Skip model đã thử
+                if self.is_model_available(fallback_model) is False:
+                    continue  # Cache: model đã chết
                 
                 self.logger.info(f"🔄 Fallback to: {fallback_model}")
-                result = self._try_single_model(prompt, fallback_model, api_key)
+                result = self._try_single_model(prompt, fallback_model, api_key, generation_config)
                 
                 if result.get("success"):
                     # Update default model nếu fallback thành công
-                    self.default_model = fallback_model
+                    self.set_default_model(fallback_model)
                     self.logger.info(f"✅ Updated default model to: {fallback_model}")
                     return result
             
@@ -755,25 +2506,11 @@ class GeminiAPIManager:
         
         return result
     
-    def _try_single_model(self, prompt, model, api_key=None):
-        """Internal: Try single model với single key"""
-        if not api_key:
-            api_key = self.get_next_available_key()
-        
-        if not api_key:
-            return {"error": "No available API keys (all rate limited)"}
-        
-        headers = {"Content-Type": "application/json"}
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent?key={api_key}"
-        
-        payload = {
+    @staticmethod
+    def _build_text_payload(prompt, generation_config=None):
+        return {
             "contents": [{"parts": [{"text": prompt}]}],
-            "generationConfig": {
-                "temperature": 0.7,
-                "topK": 40,
-                "topP": 0.95,
-                "maxOutputTokens": 4096,
-            },
+            "generationConfig": generation_config or DEFAULT_GENERATION_CONFIG,
             "safetySettings": [
                 {"category": cat, "threshold": "BLOCK_NONE"}
                 for cat in [
@@ -784,9 +2521,21 @@ class GeminiAPIManager:
                 ]
             ]
         }
+    
+    def _try_single_model(self, prompt, model, api_key=None, generation_config=None):
+        """Internal: Try single model với single key"""
+        if not api_key:
+            api_key = self.get_next_available_key(model)
+        
+        if not api_key:
+            return {"error": "No available API keys (all rate limited)"}
+        
+        headers = {"Content-Type": "application/json", "x-goog-api-key": api_key}
+        url = f"{self.base_url}/models/{model}:generateContent"
+        payload = self._build_text_payload(prompt, generation_config)
         
         try:
-            response = requests.post(url, json=payload, headers=headers, timeout=60)
+            response = self.get_http_session().post(url, json=payload, headers=headers, timeout=60)
             
             if response.status_code == 200:
                 result = response.json()
@@ -799,39 +2548,46 @@ class GeminiAPIManager:
                             content = parts[0]['text'].strip()
                             
                             if len(content) > 10:
-                                self.update_usage(api_key, True)
-                                return {"success": True, "content": content}
+                                self.update_usage(api_key, True, model=model)
+                                self.set_model_available(model, True)
+                                return {"success": True, "content": content, "model": model,
+                                        "finish_reason": candidate.get('finishReason')}
                 
                 if 'promptFeedback' in result:
                     feedback = result['promptFeedback']
                     if 'blockReason' in feedback:
                         error = f"Blocked: {feedback['blockReason']}"
-                        self.update_usage(api_key, False, error, False)
+                        self.update_usage(api_key, False, error, False, model=model, status_code=200)
                         return {"error": error}
                 
                 error = "Empty response"
-                self.update_usage(api_key, False, error, False)
+                self.update_usage(api_key, False, error, False, model=model, status_code=200)
                 return {"error": error}
             
             elif response.status_code == 429:
-                self.update_usage(api_key, False, "Rate limit", True)
-                return {"error": "Rate limit", "rate_limited": True}
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                if retry_after is None:
+                    retry_after = parse_retry_delay(response.text)
+                daily_quota = is_daily_quota_error(response.text)
+                self.update_usage(api_key, False, "Rate limit", True, retry_after, model, daily_quota)
+                return {"error": "Rate limit", "rate_limited": True, "retry_after": retry_after}
             
             elif response.status_code == 404:
                 error = f"Model '{model}' not found"
+                self.set_model_available(model, False)
                 return {"error": error, "not_found": True}
             
             else:
                 error = f"HTTP {response.status_code}"
-                self.update_usage(api_key, False, error, False)
+                self.update_usage(api_key, False, error, False, model=model, status_code=response.status_code)
                 return {"error": error}
                 
         except Exception as e:
-            error = f"Request error: {str(e)}"
-            self.update_usage(api_key, False, error, False)
+            error = f"Request error: {_redact(str(e))}"
+            self.update_usage(api_key, False, error, False, model=model)
             return {"error": error}
     
-    def call_gemini_text_api(self, prompt, model=None, retry_count=None, api_key=None):
+    def call_gemini_text_api(self, prompt, model=None, retry_count=None, api_key=None, generation_config=None):
         """Main API call với smart retry & fallback"""
         if not prompt:
             return {"error": "Empty prompt"}
@@ -839,14 +2595,18 @@ class GeminiAPIManager:
         if model is None:
             model = self.default_model
         
+        # Lần đầu trong phiên (cache hết hạn): 1 lần models.list thay vì dò từng model 404
+        self.refresh_model_availability()
+        model = self.resolve_model(model)
+        
         max_key_attempts = min(len(self.api_keys), 5)  # Try up to 5 keys
         
         for key_attempt in range(max_key_attempts):
-            current_key = self.get_next_available_key()
+            current_key = self.acquire_api_key(model)
             
             if not current_key:
                 # All keys rate limited
-                available_in = self.get_time_until_key_available()
+                available_in = self.get_time_until_key_available(model)
                 return {
                     "error": f"All {len(self.api_keys)} keys rate limited. "
                             f"Available in ~{available_in}s. "
@@ -856,7 +2616,7 @@ class GeminiAPIManager:
             self.logger.info(f"🔑 Key attempt {key_attempt + 1}/{max_key_attempts}")
             
             # Try with fallback
-            result = self.try_model_with_fallback(prompt, model, current_key)
+            result = self.try_model_with_fallback(prompt, model, current_key, generation_config)
             
             if result.get("success"):
                 return result
@@ -872,66 +2632,291 @@ class GeminiAPIManager:
         
         return {"error": f"Failed after {max_key_attempts} key attempts"}
     
-    def get_time_until_key_available(self):
-        """Get seconds until next key available"""
-        if not self.api_keys:
-            return 0
+    def _stream_single_model(self, prompt, model, api_key, generation_config=None, on_delta=None):
+        """Internal: streamGenerateContent (SSE) với 1 key, gọi on_delta(text) cho từng phần"""
+        headers = {"Content-Type": "application/json", "x-goog-api-key": api_key}
+        url = f"{self.base_url}/models/{model}:streamGenerateContent?alt=sse"
+        payload = self._build_text_payload(prompt, generation_config)
+        
+        parts = []
+        finish_reason = None
+        status_code = None
+        try:
+            with self.get_http_session().post(url, json=payload, headers=headers,
+                                              timeout=60, stream=True) as response:
+                status_code = response.status_code
+                if response.status_code == 429:
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                    if retry_after is None:
+                        retry_after = parse_retry_delay(response.text)
+                    daily_quota = is_daily_quota_error(response.text)
+                    self.update_usage(api_key, False, "Rate limit", True, retry_after, model, daily_quota)
+                    return {"error": "Rate limit", "rate_limited": True, "retry_after": retry_after}
+                
+                if response.status_code == 404:
+                    self.set_model_available(model, False)
+                    return {"error": f"Model '{model}' not found", "not_found": True}
+                
+                if response.status_code != 200:
+                    error = f"HTTP {response.status_code}"
+                    self.update_usage(api_key, False, error, False, model=model, status_code=response.status_code)
+                    return {"error": error}
+                
+                # SSE không khai báo charset -> requests mặc định ISO-8859-1
+                response.encoding = 'utf-8'
+                for line in response.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith("data:"):
+                        continue
+                    event = json.loads(line[5:].strip())
+                    
+                    block_reason = event.get('promptFeedback', {}).get('blockReason')
+                    if block_reason:
+                        error = f"Blocked: {block_reason}"
+                        self.update_usage(api_key, False, error, False, model=model, status_code=200)
+                        return {"error": error, "streamed": bool(parts)}
+                    
+                    for candidate in event.get('candidates', [])[:1]:
+                        finish_reason = candidate.get('finishReason') or finish_reason
+                        for part in candidate.get('content', {}).get('parts', []):
+                            text = part.get('text')
+                            if not text:
+                                continue
+                            if not parts:
+                                text = text.lstrip()
+                                if not text:
+                                    continue
+                            parts.append(text)
+                            if on_delta:
+                                on_delta(text)
         
-        current_time = time.time()
-        min_wait = float('inf')
+        except Exception as e:
+            error = f"Request error: {_redact(str(e))}"
+            self.update_usage(api_key, False, error, False, model=model, status_code=status_code)
+            return {"error": error, "streamed": bool(parts)}
+        
+        content = "".join(parts).strip()
+        if not content:
+            error = "Empty response"
+            self.update_usage(api_key, False, error, False, model=model, status_code=status_code)
+            return {"error": error}
+        
+        self.update_usage(api_key, True, model=model)
+        self.set_model_available(model, True)
+        return {"success": True, "content": content, "model": model, "finish_reason": finish_reason}
+    
+    def call_gemini_text_api_stream(self, prompt, model=None, on_delta=None, generation_config=None):
+        """THÊM: Như call_gemini_text_api nhưng nhận kết quả dần qua SSE (on_delta)"""
+        if not prompt:
+            return {"error": "Empty prompt"}
+        
+        if model is None:
+            model = self.default_model
+        
+        self.refresh_model_availability()
+        model = self.resolve_model(model)
         
-        for key in self.api_keys:
-            stats = self.usage_stats[key]
-            last_limit = stats.get('last_rate_limit', 0)
-            if last_limit > 0:
-                wait_time = self.rate_limit_cooldown - (current_time - last_limit)
-                if wait_time > 0:
-                    min_wait = min(min_wait, wait_time)
+        max_key_attempts = min(len(self.api_keys), 5)
+        
+        for key_attempt in range(max_key_attempts):
+            current_key = self.acquire_api_key(model)
+            
+            if not current_key:
+                available_in = self.get_time_until_key_available(model)
+                return {
+                    "error": f"All {len(self.api_keys)} keys rate limited. "
+                            f"Available in ~{available_in}s. "
+                            "Try again later or add more keys."
+                }
+            
+            self.logger.info(f"📡 Stream key attempt {key_attempt + 1}/{max_key_attempts}")
+            result = self._stream_single_model(prompt, model, current_key, generation_config, on_delta)
+            
+            if result.get("success") or result.get("streamed"):
+                # Đã hiển thị một phần -> không thử lại để tránh lặp nội dung
+                return result
+            
+            if result.get("rate_limited"):
+                self.logger.warning("⏳ Rate limited, trying next key...")
+                continue
+            
+            if result.get("not_found"):
+                # Model không có -> dùng đường thường (có fallback model), trả về 1 lần
+                self.logger.warning(f"⚠️ {model} không stream được, dùng fallback")
+                result = self.call_gemini_text_api(prompt, model, generation_config=generation_config)
+                if result.get("success") and on_delta:
+                    on_delta(result["content"])
+                return result
+            
+            return result
         
-        return int(min_wait) if min_wait != float('inf') else 0
+        return {"error": f"Failed after {max_key_attempts} key attempts"}
+    
+    def _get_wait_time(self, model=None):
+        """Số giây (float) đến khi có key cho model - O(1) peek heap"""
+        top = self.get_scheduler(model).peek()
+        if top is None:
+            return 0.0
+        return max(0.0, top[0] - time.time())
     
-    def rewrite_text_with_prompt(self, text: str, prompt_template: str) -> Dict:
+    def get_time_until_key_available(self, model=None):
+        """Get seconds until next key available"""
+        if not self.api_keys:
+            return 0
+        return int(math.ceil(self._get_wait_time(model)))
+    
+    def rewrite_text_with_prompt(self, text: str, prompt_template: str, use_cache: bool = True,
+                                 generation_config: dict = None, on_delta=None) -> Dict:
+        """Viết lại văn bản; use_cache=False để luôn lấy bản mới từ API, on_delta -> stream"""
         if not text or not prompt_template:
             return {"error": "Empty text or prompt"}
         
+        # Key cache theo model thực sự được gọi (default model có thể đang không khả dụng -> fallback)
+        self.refresh_model_availability()
+        model = self.resolve_model(self.default_model)
+        generation_config = generation_config or DEFAULT_GENERATION_CONFIG
+        cache = get_rewrite_cache()
+        cache_key = cache.make_rewrite_key(prompt_template, text, model, generation_config)
+        
+        if use_cache:
+            cached = cache.get_text(cache_key)
+            if cached is not None:
+                self.logger.info("♻️ Rewrite cache hit")
+                if on_delta:
+                    on_delta(cached)
+                return {"success": True, "rewritten_text": cached, "cached": True}
+        
         full_prompt = f"{prompt_template}\n\nVăn bản:\n{text}"
-        result = self.call_gemini_text_api(full_prompt)
+        if on_delta:
+            result = self.call_gemini_text_api_stream(full_prompt, model, on_delta, generation_config)
+        else:
+            result = self.call_gemini_text_api(full_prompt, model, generation_config=generation_config)
         
         if result.get("success"):
-            return {"success": True, "rewritten_text": result["content"]}
+            # Kết quả bị cắt do hết maxOutputTokens -> không cache
+            truncated = result.get("finish_reason") == "MAX_TOKENS"
+            if truncated:
+                self.logger.warning("✂️ Kết quả viết lại bị cắt (MAX_TOKENS), không lưu cache")
+            else:
+                # Bản mới (kể cả khi bypass) thay thế entry cũ; fallback 404 giữa chừng -> lưu theo model đã trả lời
+                used_model = result.get("model") or model
+                if used_model != model:
+                    cache_key = cache.make_rewrite_key(prompt_template, text, used_model, generation_config)
+                cache.put_text(cache_key, result["content"])
+            return {"success": True, "rewritten_text": result["content"], "truncated": truncated}
         else:
             return {"error": result.get("error", "Unknown")}
     
+    def rewrite_long_text(self, text: str, prompt_template: str, use_cache: bool = True,
+                          max_segment_tokens: int = LONG_REWRITE_SEGMENT_TOKENS,
+                          progress_callback=None, on_delta=None) -> Dict:
+        """THÊM: Viết lại văn bản dài - chia theo đoạn văn, viết lại song song qua các key, ghép theo thứ tự.
+        
+        on_delta: văn bản 1 phân đoạn -> stream; nhiều phân đoạn -> mỗi phân đoạn xong được đẩy ra theo thứ tự.
+        """
+        if not text or not prompt_template:
+            return {"error": "Empty text or prompt"}
+        
+        truncated_error = "Kết quả bị cắt do vượt maxOutputTokens (MAX_TOKENS), hãy giảm kích thước phân đoạn"
+        segments = split_text_segments(text, max_segment_tokens)
+        if len(segments) <= 1:
+            result = self.rewrite_text_with_prompt(text, prompt_template, use_cache,
+                                                   generation_config_for(text), on_delta)
+            return {"error": truncated_error} if result.get("truncated") else result
+        
+        with self._lock:
+            key_count = len(self.api_keys)
+        workers = max(1, min(len(segments), key_count, MAX_REWRITE_CONCURRENCY))
+        self.logger.info(f"📚 Văn bản dài: {len(segments)} phân đoạn, {workers} luồng")
+        
+        results = [None] * len(segments)
+        done = 0
+        next_emit = 0
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            futures = {
+                executor.submit(self.rewrite_text_with_prompt, segment, prompt_template,
+                                use_cache, generation_config_for(segment)): i
+                for i, segment in enumerate(segments)
+            }
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = {"error": str(e)}
+                
+                # Phân đoạn hỏng -> cả văn bản hỏng: dừng ngay, hủy các phân đoạn chưa chạy
+                if result.get("truncated"):
+                    return {"error": f"Phân đoạn {i+1}/{len(segments)}: {truncated_error}"}
+                if not result.get("success"):
+                    return {"error": f"Phân đoạn {i+1}/{len(segments)}: {result.get('error', 'Unknown')}"}
+                
+                results[i] = result
+                done += 1
+                if progress_callback:
+                    progress_callback(done, len(segments))
+                
+                while on_delta and next_emit < len(segments) and results[next_emit] is not None:
+                    separator = "\n\n" if next_emit else ""
+                    on_delta(separator + results[next_emit]["rewritten_text"].strip())
+                    next_emit += 1
+        finally:
+            # Không chờ các request đang chạy (kết quả bị bỏ, vẫn được ghi cache)
+            executor.shutdown(wait=False, cancel_futures=True)
+        
+        return {
+            "success": True,
+            "rewritten_text": "\n\n".join(r["rewritten_text"].strip() for r in results),
+            "segments": len(segments),
+            "cached": all(r.get("cached") for r in results),
+        }
+    
+    @staticmethod
+    def _tts_config(voice: str):
+        return genai_types.GenerateContentConfig(
+            response_modalities=["AUDIO"],
+            speech_config=genai_types.SpeechConfig(
+                voice_config=genai_types.VoiceConfig(
+                    prebuilt_voice_config=genai_types.PrebuiltVoiceConfig(
+                        voice_name=voice,
+                    )
+                )
+            ),
+        )
+    
+    def _tts_error(self, api_key: str, e: Exception, status_code=None) -> Dict:
+        """Ghi nhận lỗi TTS (429/RESOURCE_EXHAUSTED -> chặn key theo retryDelay)"""
+        error = _redact(str(e))
+        code = getattr(e, 'code', None)
+        if isinstance(code, int):
+            status_code = code
+        is_rate_limit = status_code == 429 or "RESOURCE_EXHAUSTED" in error
+        retry_after = parse_retry_delay(error) if is_rate_limit else None
+        daily_quota = is_rate_limit and is_daily_quota_error(error)
+        self.update_usage(api_key, False, error, is_rate_limit, retry_after, self.tts_model, daily_quota,
+                          status_code=429 if is_rate_limit else status_code)
+        if is_rate_limit:
+            return {"error": error, "rate_limited": True, "retry_after": retry_after}
+        return {"error": error}
+    
     def call_gemini_tts_api(self, text: str, voice: str = "Kore") -> Dict:
         if not text:
             return {"error": "Empty text"}
         
-        api_key = self.get_next_available_key()
+        if not GENAI_AVAILABLE:
+            return {"error": "google-genai not installed"}
+        
+        api_key = self.acquire_api_key(self.tts_model)
         if not api_key:
             return {"error": "No available keys"}
         
         try:
-            from google import genai
-            from google.genai import types
-        except ImportError:
-            return {"error": "google-genai not installed"}
-        
-        try:
-            client = genai.Client(api_key=api_key)
+            client = self.get_genai_client(api_key)
             
             response = client.models.generate_content(
-                model="gemini-2.0-flash-exp",
+                model=self.tts_model,
                 contents=text,
-                config=types.GenerateContentConfig(
-                    response_modalities=["AUDIO"],
-                    speech_config=types.SpeechConfig(
-                        voice_config=types.VoiceConfig(
-                            prebuilt_voice_config=types.PrebuiltVoiceConfig(
-                                voice_name=voice,
-                            )
-                        )
-                    ),
-                )
+                config=self._tts_config(voice)
             )
             
             if response.candidates and response.candidates[0].content.parts:
@@ -941,42 +2926,171 @@ class GeminiAPIManager:
                         if isinstance(audio_data, str):
                             audio_data = base64.b64decode(audio_data)
                         
-                        self.update_usage(api_key, True)
+                        self.update_usage(api_key, True, model=self.tts_model)
                         return {"success": True, "audio_data": audio_data}
             
+            self.update_usage(api_key, False, "No audio data", model=self.tts_model, status_code=200)
             return {"error": "No audio data"}
         except Exception as e:
-            self.update_usage(api_key, False, str(e), False)
-            return {"error": str(e)}
+            return self._tts_error(api_key, e)
     
-    def get_usage_stats(self):
-        stats = {
-            "total_keys": len(self.api_keys),
-            "available_keys": sum(1 for k in self.api_keys 
-                                 if time.time() - self.usage_stats[k].get('last_rate_limit', 0) > self.rate_limit_cooldown),
-            "total_calls": sum(s["calls"] for s in self.usage_stats.values()),
-            "successful_calls": sum(s.get("successful_calls", 0) for s in self.usage_stats.values()),
-            "total_errors": sum(s["errors"] for s in self.usage_stats.values()),
-            "total_rate_limits": sum(s.get("rate_limits", 0) for s in self.usage_stats.values()),
-            "keys": []
-        }
+    def call_gemini_tts_api_stream(self, text: str, voice: str, output_file: str,
+                                   channels: int = 1, rate: int = 24000, sample_width: int = 2) -> Dict:
+        """THÊM: TTS dạng stream - ghi PCM vào WAV ngay khi nhận, header được sửa khi đóng file.
         
-        for key in self.api_keys:
-            s = self.usage_stats[key]
-            time_since_limit = time.time() - s.get('last_rate_limit', 0)
-            is_available = time_since_limit > self.rate_limit_cooldown or s.get('last_rate_limit', 0) == 0
-            
-            stats["keys"].append({
-                "suffix": key[-8:],
-                "calls": s["calls"],
-                "success": s.get("successful_calls", 0),
-                "errors": s["errors"],
-                "rate_limits": s.get("rate_limits", 0),
-                "available": is_available,
-                "cooldown_remaining": max(0, int(self.rate_limit_cooldown - time_since_limit)) if not is_available else 0
-            })
+        Ghi vào file .part rồi đổi tên, nên output_file chỉ xuất hiện khi đã đủ audio.
+        Bị rate limit -> thử key khác (file .part đã xóa nên ghi lại từ đầu).
+        Lỗi trước khi nhận được audio (không phải rate limit) -> "fallback": True để gọi lại kiểu thường.
+        """
+        if not text:
+            return {"error": "Empty text"}
         
-        return stats
+        if not GENAI_AVAILABLE:
+            return {"error": "google-genai not installed"}
+        
+        max_key_attempts = max(1, min(len(self.api_keys), 5))
+        result = {"error": "No available keys"}
+        for key_attempt in range(max_key_attempts):
+            api_key = self.acquire_api_key(self.tts_model)
+            if not api_key:
+                return result if result.get("rate_limited") else {"error": "No available keys"}
+            
+            result = self._tts_stream_single_key(api_key, text, voice, output_file, channels, rate, sample_width)
+            if not result.get("rate_limited"):
+                return result
+            self.logger.warning(f"⏳ TTS stream rate limited, thử key khác ({key_attempt + 1}/{max_key_attempts})")
+        return result
+    
+    def _tts_stream_single_key(self, api_key: str, text: str, voice: str, output_file: str,
+                               channels: int, rate: int, sample_width: int) -> Dict:
+        """Internal: 1 lần generate_content_stream với 1 key"""
+        part_file = f"{output_file}.part"
+        frame_size = channels * sample_width
+        wf = None
+        written = 0
+        remainder = b""
+        try:
+            client = self.get_genai_client(api_key)
+            stream = client.models.generate_content_stream(
+                model=self.tts_model,
+                contents=text,
+                config=self._tts_config(voice)
+            )
+            
+            for chunk in stream:
+                if not chunk.candidates or not chunk.candidates[0].content or not chunk.candidates[0].content.parts:
+                    continue
+                for part in chunk.candidates[0].content.parts:
+                    if not getattr(part, 'inline_data', None) or not part.inline_data.data:
+                        continue
+                    data = part.inline_data.data
+                    if isinstance(data, str):
+                        data = base64.b64decode(data)
+                    
+                    if wf is None:
+                        wf = wave.open(part_file, "wb")
+                        wf.setnchannels(channels)
+                        wf.setsampwidth(sample_width)
+                        wf.setframerate(rate)
+                    
+                    # Chỉ ghi trọn frame, phần lẻ để dành cho chunk sau
+                    data = remainder + data
+                    usable = len(data) - len(data) % frame_size
+                    wf.writeframesraw(data[:usable])
+                    remainder = data[usable:]
+                    written += usable
+            
+            if wf is None:
+                # Request đã tính vào quota dù không có audio
+                self.update_usage(api_key, False, "No audio data", model=self.tts_model, status_code=200)
+                return {"error": "No audio data", "fallback": True}
+            
+            wf.close()  # wave sửa kích thước trong header khi đóng
+            wf = None
+            os.replace(part_file, output_file)
+            self.update_usage(api_key, True, model=self.tts_model)
+            return {"success": True, "file_path": output_file, "bytes": written}
+        
+        except Exception as e:
+            # Đã nhận audio -> server đã chấp nhận request (lỗi giữa stream)
+            result = self._tts_error(api_key, e, 200 if written else None)
+            if not written and not result.get("rate_limited"):
+                result["fallback"] = True
+            return result
+        finally:
+            if wf is not None:
+                try:
+                    wf.close()
+                except Exception:
+                    pass
+            if os.path.exists(part_file):
+                try:
+                    os.remove(part_file)
+                except OSError:
+                    pass
+    
+    def get_usage_stats(self, model=None):
+        """Stats tổng hợp; "available" tính theo model (mặc định: text model)"""
+        with self._lock:
+            model = model or self.default_model
+            current_time = time.time()
+            waits = {k: self.get_rate_limiter(k, model).blocked_for(current_time) for k in self.api_keys}
+            
+            rpd = self.get_model_rate_limit(model).get("rpd")
+            
+            stats = {
+                "model": model,
+                "total_keys": len(self.api_keys),
+                "available_keys": sum(1 for k in self.api_keys if waits[k] <= 0),
+                "total_calls": sum(s["calls"] for s in self.usage_stats.values()),
+                "successful_calls": sum(s.get("successful_calls", 0) for s in self.usage_stats.values()),
+                "total_errors": sum(s["errors"] for s in self.usage_stats.values()),
+                "total_rate_limits": sum(s.get("rate_limits", 0) for s in self.usage_stats.values()),
+                "daily_remaining": 0 if rpd else None,
+                "keys": []
+            }
+            
+            for key in self.api_keys:
+                s = self.usage_stats[key]
+                is_available = waits[key] <= 0
+            
+                models = {}
+                for model_name, ms in s.get("models", {}).items():
+                    blocked = self.get_rate_limiter(key, model_name).blocked_for(current_time)
+                    self._roll_daily_quota(ms, current_time)
+                    model_rpd = self.get_model_rate_limit(model_name).get("rpd")
+                    models[model_name] = {
+                        "calls": ms["calls"],
+                        "success": ms.get("successful_calls", 0),
+                        "errors": ms["errors"],
+                        "rate_limits": ms.get("rate_limits", 0),
+                        "available": blocked <= 0,
+                        "cooldown_remaining": int(math.ceil(blocked)),
+                        "daily_calls": ms["daily_calls"],
+                        "daily_limit": model_rpd,
+                        "daily_remaining": self._daily_remaining(ms, model_rpd),
+                        "daily_reset_in": int(max(0, ms["daily_reset_at"] - current_time)),
+                    }
+                
+                model_stats = s.get("models", {}).get(model)
+                daily_remaining = (self._daily_remaining(model_stats, rpd) if model_stats
+                                   else rpd)
+                if daily_remaining is not None and stats["daily_remaining"] is not None:
+                    stats["daily_remaining"] += daily_remaining
+            
+                stats["keys"].append({
+                    "suffix": key[-8:],
+                    "calls": s["calls"],
+                    "success": s.get("successful_calls", 0),
+                    "errors": s["errors"],
+                    "rate_limits": s.get("rate_limits", 0),
+                    "available": is_available,
+                    "cooldown_remaining": int(math.ceil(waits[key])) if not is_available else 0,
+                    "daily_remaining": daily_remaining,
+                    "models": models
+                })
+            
+            return stats
         
 # =====================================
 # TTS WORKER V6.0
@@ -1000,6 +3114,7 @@ class SmartTTSWorkerV6(QThread):
         self.is_cancelled = False
         self.mutex = QMutex()
         self.text_processor = EnhancedTextProcessor()
+        self.audio_cache = get_tts_audio_cache() if processing_config.get('use_audio_cache', True) else None
         
     def cancel(self):
         with QMutexLocker(self.mutex):
@@ -1010,9 +3125,12 @@ class SmartTTSWorkerV6(QThread):
             self.status_updated.emit("🧠 Đang phân tích văn bản...")
             
             if not self.style_analysis:
-                self.style_analysis = self.text_processor.create_style_analysis_json(
-                    self.original_text, 
-                    self.processing_config.get('voice_mappings', None)
+                self.style_analysis = self.text_processor.plan_chunks(
+                    self.text_processor.create_style_analysis_json(
+                        self.original_text, 
+                        self.processing_config.get('voice_mappings', None)
+                    ),
+                    self.processing_config.get('chunk_max_chars', DEFAULT_CHUNK_MAX_CHARS)
                 )
             
             if not self.style_analysis:
@@ -1020,21 +3138,111 @@ class SmartTTSWorkerV6(QThread):
                 return
             
             self.status_updated.emit(f"📝 Đã phân tích {len(self.style_analysis)} đoạn")
+            cache_before = self.audio_cache.stats() if self.audio_cache is not None else None
             self._process_tts_v6()
             
+            if cache_before is not None:
+                cache_after = self.audio_cache.stats()
+                self.status_updated.emit(
+                    f"💾 Cache audio: {cache_after['hits'] - cache_before['hits']} hit / "
+                    f"{cache_after['misses'] - cache_before['misses']} miss"
+                )
+            
         except Exception as e:
             self.error_occurred.emit(f"Lỗi worker: {str(e)}")
     
+    def _is_cancelled(self):
+        with QMutexLocker(self.mutex):
+            return self.is_cancelled
+    
+    def _get_concurrency(self):
+        """Số request TTS song song cho job này (giới hạn bởi số key)"""
+        try:
+            concurrency = int(self.processing_config.get('tts_concurrency', 1))
+        except (TypeError, ValueError):
+            concurrency = 1
+        concurrency = min(concurrency, MAX_TTS_CONCURRENCY, max(len(self.gemini_api.api_keys), 1))
+        return max(1, concurrency)
+    
+    @staticmethod
+    def _is_retryable(result):
+        """Lỗi tạm thời (429 / chưa có key rảnh) - key khác hoặc sau cooldown vẫn làm được"""
+        return bool(result.get("rate_limited")) or result.get("error") == "No available keys"
+    
+    def _retry_delay(self):
+        """Số giây tới khi scheduler có key rảnh cho model TTS (1s..max_key_wait).
+        None nếu key sớm nhất còn xa hơn max_key_wait (thường là hết quota ngày) -> không thử lại"""
+        wait_time = self.gemini_api.get_time_until_key_available(self.gemini_api.tts_model)
+        if wait_time > self.gemini_api.max_key_wait:
+            return None
+        return max(1, int(math.ceil(wait_time)))
+    
+    def _quota_exhausted_error(self, i):
+        return (f"Lỗi TTS đoạn {i+1}: hết quota ngày (daily quota exhausted) - "
+                f"không key nào rảnh trong {self.gemini_api.max_key_wait}s")
+    
+    def _wait_or_cancel(self, seconds):
+        """Chờ, trả về False nếu bị hủy trong lúc chờ"""
+        deadline = time.time() + seconds
+        while time.time() < deadline:
+            if self._is_cancelled():
+                return False
+            time.sleep(min(0.2, max(0.0, deadline - time.time())))
+        return not self._is_cancelled()
+    
+    def _synthesize_chunk(self, i, chunk_info, output_dir):
+        """Synthesize 1 đoạn -> (file_path, None, False) hoặc (None, error_msg, retryable)"""
+        voice_name = chunk_info.get('voice', 'Kore')
+        language = chunk_info.get('language', 'unknown')
+        style = chunk_info.get('style', 'bình thường')
+        
+        lang_code = 'ja' if language == 'JAPANESE' else 'vi' if language == 'vietnamese' else 'mix'
+        file_name = f"chunk_{i+1:03d}_{lang_code}_{voice_name}_{style.replace(' ', '_')}.wav"
+        file_path = os.path.join(output_dir, file_name)
+        
+        # THÊM: Cache hit -> chỉ copy file, không gọi API
+        cache_key = None
+        if self.audio_cache is not None:
+            cache_key = self.audio_cache.make_audio_key(
+                chunk_info['text'], voice_name, self.gemini_api.tts_model
+            )
+            if self.audio_cache.copy_to(cache_key, file_path):
+                return file_path, None, False
+        
+        result = None
+        if self.processing_config.get('stream_tts', True):
+            result = self.gemini_api.call_gemini_tts_api_stream(chunk_info['text'], voice_name, file_path)
+            if not result.get("success") and not result.get("fallback"):
+                return None, f"Lỗi TTS đoạn {i+1}: {result.get('error')}", self._is_retryable(result)
+        
+        if result is None or not result.get("success"):
+            result = self.gemini_api.call_gemini_tts_api(chunk_info['text'], voice_name)
+            
+            if not result.get("success"):
+                return None, f"Lỗi TTS đoạn {i+1}: {result.get('error')}", self._is_retryable(result)
+            
+            if not save_wav_file(file_path, result["audio_data"]):
+                return None, f"Lỗi lưu file {file_name}", False
+        
+        if cache_key is not None:
+            self.audio_cache.put_file(cache_key, file_path)
+        
+        return file_path, None, False
+    
     def _process_tts_v6(self):
+        concurrency = self._get_concurrency()
+        if concurrency > 1:
+            self._process_tts_parallel(concurrency)
+            return
+        
         audio_files = []
         total_chunks = len(self.style_analysis)
         output_dir = self.processing_config.get('output_dir', '')
         
         for i, chunk_info in enumerate(self.style_analysis):
-            with QMutexLocker(self.mutex):
-                if self.is_cancelled:
-                    self.error_occurred.emit("Đã hủy")
-                    return
+            if self._is_cancelled():
+                self.error_occurred.emit("Đã hủy")
+                return
             
             progress = int((i / total_chunks) * 100)
             self.progress_updated.emit(progress)
@@ -1046,25 +3254,118 @@ class SmartTTSWorkerV6(QThread):
             status_msg = f"Xử lý đoạn {i+1}/{total_chunks} ({language}) - {voice_name} - {style}"
             self.status_updated.emit(status_msg)
             
-            result = self.gemini_api.call_gemini_tts_api(chunk_info['text'], voice_name)
-            
-            if result.get("success"):
-                lang_code = 'ja' if language == 'JAPANESE' else 'vi' if language == 'vietnamese' else 'mix'
-                file_name = f"chunk_{i+1:03d}_{lang_code}_{voice_name}_{style.replace(' ', '_')}.wav"
-                file_path = os.path.join(output_dir, file_name)
-                
-                if save_wav_file(file_path, result["audio_data"]):
-                    audio_files.append(file_path)
-                    self.chunk_completed.emit(i+1, file_path, chunk_info)
-                else:
-                    self.error_occurred.emit(f"Lỗi lưu file {file_name}")
+            for attempt in range(1, TTS_CHUNK_MAX_ATTEMPTS + 1):
+                file_path, error_msg, retryable = self._synthesize_chunk(i, chunk_info, output_dir)
+                if not error_msg or not retryable or attempt == TTS_CHUNK_MAX_ATTEMPTS:
+                    break
+                delay = self._retry_delay()
+                if delay is None:
+                    error_msg = self._quota_exhausted_error(i)
+                    break
+                self.status_updated.emit(
+                    f"⏳ Đoạn {i+1} bị rate limit, thử lại sau {delay}s (lần {attempt + 1}/{TTS_CHUNK_MAX_ATTEMPTS})"
+                )
+                if not self._wait_or_cancel(delay):
+                    self.error_occurred.emit("Đã hủy")
                     return
-            else:
-                error_msg = f"Lỗi TTS đoạn {i+1}: {result.get('error')}"
+            
+            if error_msg:
                 self.error_occurred.emit(error_msg)
                 return
             
-            time.sleep(0.5)
+            audio_files.append(file_path)
+            self.chunk_completed.emit(i+1, file_path, chunk_info)
+        
+        self.progress_updated.emit(100)
+        self.status_updated.emit("🎉 Hoàn thành!")
+        self.completed.emit(audio_files)
+    
+    def _process_tts_parallel(self, concurrency):
+        """THÊM: Synthesize song song, trả kết quả theo đúng thứ tự văn bản"""
+        audio_files = []
+        total_chunks = len(self.style_analysis)
+        output_dir = self.processing_config.get('output_dir', '')
+        # Giới hạn số đoạn đã xong nhưng chưa emit (chờ đoạn trước đó)
+        window = concurrency * 4
+        
+        in_flight = {}   # future -> index
+        finished = {}    # index -> (file_path, error_msg)
+        attempts = {}    # index -> số lần đã gửi
+        retry_at = {}    # index -> thời điểm gửi lại (đoạn bị rate limit)
+        next_submit = 0
+        next_emit = 0
+        
+        self.status_updated.emit(f"⚡ TTS song song: {concurrency} luồng")
+        executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="tts")
+        
+        try:
+            while next_emit < total_chunks:
+                if self._is_cancelled():
+                    self.error_occurred.emit("Đã hủy")
+                    return
+                
+                while len(in_flight) < concurrency:
+                    # Đoạn thử lại đến hạn được ưu tiên (các đoạn sau đang chờ nó để emit)
+                    now = time.time()
+                    due = [index for index, at in retry_at.items() if at <= now]
+                    if due:
+                        index = min(due)
+                        del retry_at[index]
+                    elif next_submit < total_chunks and next_submit - next_emit < window:
+                        index = next_submit
+                        next_submit += 1
+                    else:
+                        break
+                    
+                    chunk_info = self.style_analysis[index]
+                    self.status_updated.emit(
+                        f"Xử lý đoạn {index+1}/{total_chunks} ({chunk_info.get('language', 'unknown')}) - "
+                        f"{chunk_info.get('voice', 'Kore')} - {chunk_info.get('style', 'bình thường')}"
+                    )
+                    future = executor.submit(self._synthesize_chunk, index, chunk_info, output_dir)
+                    in_flight[future] = index
+                    attempts[index] = attempts.get(index, 0) + 1
+                
+                if not in_flight:
+                    # Chỉ còn đoạn chờ thử lại
+                    time.sleep(0.2)
+                    continue
+                
+                # Timeout ngắn để cancel() có hiệu lực nhanh
+                done, _ = wait(list(in_flight), timeout=0.2, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = in_flight.pop(future)
+                    try:
+                        file_path, error_msg, retryable = future.result()
+                    except Exception as e:
+                        file_path, error_msg, retryable = None, f"Lỗi TTS đoạn {index+1}: {str(e)}", False
+                    
+                    if error_msg and retryable and attempts[index] < TTS_CHUNK_MAX_ATTEMPTS:
+                        delay = self._retry_delay()
+                        if delay is None:
+                            finished[index] = (None, self._quota_exhausted_error(index))
+                            continue
+                        retry_at[index] = time.time() + delay
+                        self.status_updated.emit(
+                            f"⏳ Đoạn {index+1} bị rate limit, thử lại sau {delay}s "
+                            f"(lần {attempts[index] + 1}/{TTS_CHUNK_MAX_ATTEMPTS})"
+                        )
+                        continue
+                    finished[index] = (file_path, error_msg)
+                
+                while next_emit in finished:
+                    file_path, error_msg = finished.pop(next_emit)
+                    if error_msg:
+                        self.error_occurred.emit(error_msg)
+                        return
+                    
+                    audio_files.append(file_path)
+                    self.chunk_completed.emit(next_emit+1, file_path, self.style_analysis[next_emit])
+                    next_emit += 1
+                    self.progress_updated.emit(int((next_emit / total_chunks) * 100))
+        finally:
+            # Không chờ request đang chạy, hủy các đoạn chưa bắt đầu
+            executor.shutdown(wait=False, cancel_futures=True)
         
         self.progress_updated.emit(100)
         self.status_updated.emit("🎉 Hoàn thành!")
@@ -1456,6 +3757,9 @@ class MainWindow(QWidget):
         self.audio_files = []
         self.text_processor = EnhancedTextProcessor()
         self.current_style_analysis = []
+        self.sentence_analysis = []  # THÊM: phân tích từng câu, current_style_analysis là đoạn đã gộp
+        self.analyzed_text = ""  # THÊM: processed_text tương ứng với sentence_analysis
+        self.planned_chunk_chars = None  # THÊM: max_chars đã dùng để lập current_style_analysis
         self.prompts = load_prompts()
         self.japanese_highlighter = None
         self.manual_highlights = []
@@ -1612,7 +3916,7 @@ class MainWindow(QWidget):
     def on_model_changed(self):
         """Handle model change - THÊM MỚI"""
         selected_model = self.model_combo.currentData()
-        self.gemini_api.default_model = selected_model
+        self.gemini_api.set_default_model(selected_model)
         self.log(f"🤖 Đã chọn model: {self.model_combo.currentText()}")
     
     def create_text_section(self):
@@ -1645,6 +3949,10 @@ Ví dụ:
         self.cb_random_prompt.setToolTip("Random prompt")
         rewrite_layout.addWidget(self.cb_random_prompt)
         
+        self.cb_fresh_rewrite = QCheckBox("🆕")
+        self.cb_fresh_rewrite.setToolTip("Bỏ qua cache - luôn tạo bản viết lại mới")
+        rewrite_layout.addWidget(self.cb_fresh_rewrite)
+        
         self.btn_rewrite = QPushButton("🔄 Viết Lại")
         self.btn_rewrite.clicked.connect(self.rewrite_and_analyze)
         rewrite_layout.addWidget(self.btn_rewrite)
@@ -1733,6 +4041,38 @@ Ví dụ:
         self.cb_keep_chunks = QCheckBox("📂 Giữ chunks")
         layout.addWidget(self.cb_keep_chunks)
         
+        self.cb_audio_cache = QCheckBox("💾 Cache audio")
+        self.cb_audio_cache.setChecked(True)
+        self.cb_audio_cache.setToolTip("Dùng lại audio đã tạo cho câu giống hệt (cùng giọng, model)")
+        layout.addWidget(self.cb_audio_cache)
+        
+        self.cb_stream_tts = QCheckBox("📡 Stream TTS")
+        self.cb_stream_tts.setChecked(True)
+        self.cb_stream_tts.setToolTip("Ghi audio ra file ngay khi nhận (ít RAM với đoạn dài)")
+        layout.addWidget(self.cb_stream_tts)
+        
+        # TTS song song
+        concurrency_layout = QHBoxLayout()
+        concurrency_layout.addWidget(QLabel("⚡ Luồng TTS:"))
+        self.spin_tts_concurrency = QSpinBox()
+        self.spin_tts_concurrency.setRange(1, MAX_TTS_CONCURRENCY)
+        self.spin_tts_concurrency.setValue(DEFAULT_TTS_CONCURRENCY)
+        self.spin_tts_concurrency.setToolTip("Số đoạn synthesize cùng lúc (chia đều cho các API key)")
+        concurrency_layout.addWidget(self.spin_tts_concurrency)
+        layout.addLayout(concurrency_layout)
+        
+        # Gộp câu thành đoạn
+        chunk_layout = QHBoxLayout()
+        chunk_layout.addWidget(QLabel("📦 Ký tự/đoạn:"))
+        self.spin_chunk_chars = QSpinBox()
+        self.spin_chunk_chars.setRange(0, MAX_CHUNK_MAX_CHARS)
+        self.spin_chunk_chars.setSingleStep(50)
+        self.spin_chunk_chars.setValue(DEFAULT_CHUNK_MAX_CHARS)
+        self.spin_chunk_chars.setSpecialValueText("Mỗi câu")
+        self.spin_chunk_chars.setToolTip("Gộp câu ngắn cùng ngôn ngữ/giọng và tách câu dài theo số ký tự (0 = mỗi câu 1 đoạn)")
+        chunk_layout.addWidget(self.spin_chunk_chars)
+        layout.addLayout(chunk_layout)
+        
         return widget
     
     def create_control_section(self):
@@ -1952,7 +4292,7 @@ Ví dụ:
         
         def test_worker():
             results = []
-            for key in self.gemini_api.api_keys:
+            for key in self.gemini_api.get_api_keys():
                 result = self.gemini_api.call_gemini_text_api("Test", api_key=key)
                 results.append({
                     'suffix': key[-8:],
@@ -2017,6 +4357,8 @@ Ví dụ:
             text = f"<span style='color:{color};'>{status} keys</span> | "
             text += f"{stats['total_calls']} calls | "
             text += f"{success_rate:.1f}% success"
+            if stats.get("daily_remaining") is not None:
+                text += f" | còn {stats['daily_remaining']} req/ngày"
             
             self.api_stats_label.setText(text)
 
@@ -2083,38 +4425,58 @@ Ví dụ:
             finished = pyqtSignal(dict)
             error = pyqtSignal(str)
             status = pyqtSignal(str)
+            delta = pyqtSignal(str)
             
-            def __init__(self, gemini_api, text, prompt_template, text_processor, voice_mappings):
+            def __init__(self, gemini_api, text, prompt_template, text_processor, voice_mappings,
+                         use_cache=True, chunk_max_chars=DEFAULT_CHUNK_MAX_CHARS):
                 super().__init__()
                 self.gemini_api = gemini_api
                 self.text = text
                 self.prompt_template = prompt_template
                 self.text_processor = text_processor
                 self.voice_mappings = voice_mappings
+                self.use_cache = use_cache
+                self.chunk_max_chars = chunk_max_chars
             
             def run(self):
                 try:
-                    # Step 1: Rewrite
+                    # Step 1: Rewrite (stream) + Step 2: phân tích từng câu khi câu hoàn chỉnh
                     self.status.emit("🔄 Viết lại...")
-                    rewrite_result = self.gemini_api.rewrite_text_with_prompt(
-                        self.text, self.prompt_template
+                    if self.text_processor.parallel_analysis_enabled(len(self.text)):
+                        prewarm_analysis_pool()
+                    analyzer = StreamingSentenceAnalyzer(self.text_processor, self.voice_mappings)
+                    
+                    def on_delta(text):
+                        self.delta.emit(text)
+                        if analyzer.feed(text):
+                            self.status.emit(f"🧠 Đã phân tích {len(analyzer.analysis)} câu...")
+                    
+                    rewrite_result = self.gemini_api.rewrite_long_text(
+                        self.text, self.prompt_template, self.use_cache,
+                        progress_callback=lambda done, total: self.status.emit(
+                            f"✍️ Viết lại phân đoạn {done}/{total}..."
+                        ),
+                        on_delta=on_delta
                     )
                     
                     if not rewrite_result.get("success"):
                         self.error.emit(rewrite_result.get("error", "Unknown"))
                         return
                     
+                    if rewrite_result.get("cached"):
+                        self.status.emit("♻️ Dùng kết quả viết lại đã cache")
+                    
                     rewritten = rewrite_result["rewritten_text"]
                     
-                    # Step 2: Analyze
-                    self.status.emit("🧠 Phân tích...")
-                    analysis = self.text_processor.create_style_analysis_json(
-                        rewritten, self.voice_mappings
-                    )
+                    analyzer.finish()
+                    sentence_analysis = analyzer.analysis
+                    analysis = self.text_processor.plan_chunks(sentence_analysis, self.chunk_max_chars)
                     
                     self.finished.emit({
                         "rewritten_text": rewritten,
-                        "style_analysis": analysis
+                        "sentence_analysis": sentence_analysis,
+                        "style_analysis": analysis,
+                        "chunk_max_chars": self.chunk_max_chars
                     })
                     
                 except Exception as e:
@@ -2132,15 +4494,25 @@ Ví dụ:
         # Start worker
         self.rewrite_worker = RewriteWorker(
             self.gemini_api, text, prompt_template,
-            self.text_processor, voice_mappings
+            self.text_processor, voice_mappings,
+            use_cache=not self.cb_fresh_rewrite.isChecked(),
+            chunk_max_chars=self.spin_chunk_chars.value()
         )
         self.rewrite_worker.finished.connect(
             lambda result: self.rewrite_completed(result, prompt_name)
         )
         self.rewrite_worker.error.connect(self.rewrite_error)
         self.rewrite_worker.status.connect(self.status_updated)
+        self.rewrite_worker.delta.connect(self.on_rewrite_delta)
         self.rewrite_worker.start()
     
+    def on_rewrite_delta(self, text):
+        """THÊM: Hiển thị dần kết quả viết lại"""
+        cursor = self.processed_text.textCursor()
+        cursor.movePosition(cursor.MoveOperation.End)
+        cursor.insertText(text)
+        self.processed_text.setTextCursor(cursor)
+    
     def rewrite_completed(self, result, prompt_name):
         """Handle completion - ĐÃ SỬA"""
         try:
@@ -2148,7 +4520,10 @@ Ví dụ:
             analysis = result["style_analysis"]
             
             self.processed_text.setPlainText(rewritten)
+            self.sentence_analysis = result.get("sentence_analysis", [])
             self.current_style_analysis = analysis
+            self.analyzed_text = self.processed_text.toPlainText()
+            self.planned_chunk_chars = result.get("chunk_max_chars")
             
             self.btn_rewrite.setEnabled(True)
             self.btn_rewrite.setText("🔄 Viết Lại")
@@ -2158,7 +4533,7 @@ Ví dụ:
             self.btn_export_json.setEnabled(True)
             self.btn_copy_json.setEnabled(True)
             
-            self.log(f"✅ Hoàn thành {len(analysis)} đoạn")
+            self.log(f"✅ Hoàn thành {len(analysis)} đoạn ({len(self.sentence_analysis)} câu)")
             
             # Summary
             lang_stats = {}
@@ -2185,6 +4560,7 @@ Ví dụ:
         """Handle error"""
         self.btn_rewrite.setEnabled(True)
         self.btn_rewrite.setText("🔄 Viết Lại")
+        self.processed_text.clear()  # Bỏ phần đã stream dở
         
         self.log(f"❌ Lỗi: {error_msg}")
         QMessageBox.critical(self, "Lỗi", f"Lỗi:\n{error_msg}")
@@ -2251,11 +4627,47 @@ Ví dụ:
             self.processed_text.setStyleSheet("")
             self.btn_edit.setText("✏️ Edit")
             self.log("🔒 Khóa edit")
+            self.reanalyze_edited_text()
+    
+    def reanalyze_edited_text(self):
+        """THÊM: Phân tích lại processed_text sau khi sửa - chỉ câu thay đổi, đoạn không đổi giữ nguyên"""
+        text = self.processed_text.toPlainText()
+        if not self.sentence_analysis or text == self.analyzed_text:
+            return
+        
+        voice_mappings = {
+            'vietnamese': self.combo_vn_voice.currentData(),
+            'japanese': self.combo_jp_voice.currentData(),
+            'mixed': self.combo_vn_voice.currentData()
+        }
+        analysis, reused = self.text_processor.update_style_analysis(
+            self.sentence_analysis, text, voice_mappings
+        )
+        
+        max_chars = self.spin_chunk_chars.value()
+        previous_texts = {chunk["text"] for chunk in self.current_style_analysis}
+        if max_chars == self.planned_chunk_chars:
+            chunks = self.text_processor.replan_chunks(self.current_style_analysis, analysis, reused, max_chars)
+        else:
+            chunks = self.text_processor.plan_chunks(analysis, max_chars)
+        unchanged = sum(1 for chunk in chunks if chunk["text"] in previous_texts)
+        
+        self.sentence_analysis = analysis
+        self.current_style_analysis = chunks
+        self.analyzed_text = text
+        self.planned_chunk_chars = max_chars
+        self.update_style_display()
+        
+        self.log(f"🧠 Phân tích lại {len(analysis) - len(reused)}/{len(analysis)} câu, "
+                 f"giữ nguyên {unchanged}/{len(chunks)} đoạn")
     
     def clear_all_text(self):
         self.text_input.clear()
         self.processed_text.clear()
         self.current_style_analysis = []
+        self.sentence_analysis = []
+        self.analyzed_text = ""
+        self.planned_chunk_chars = None
         self.style_display.clear()
         self.manual_highlights = []
         self.btn_export_json.setEnabled(False)
@@ -2297,12 +4709,25 @@ Ví dụ:
             QMessageBox.warning(self, "Cảnh báo", "Chưa có phân tích!")
             return
         
+        # THÊM: Phân tích lại phần đã sửa (nếu chưa khóa edit), lập lại đoạn khi đổi số ký tự
+        self.reanalyze_edited_text()
+        if self.sentence_analysis and self.spin_chunk_chars.value() != self.planned_chunk_chars:
+            self.current_style_analysis = self.text_processor.plan_chunks(
+                self.sentence_analysis, self.spin_chunk_chars.value()
+            )
+            self.planned_chunk_chars = self.spin_chunk_chars.value()
+            self.update_style_display()
+        
         # Config
         config = {
             'output_dir': self.output_path.text(),
             'output_filename': self.output_filename.text(),
             'auto_merge': self.cb_auto_merge.isChecked(),
             'keep_chunks': self.cb_keep_chunks.isChecked(),
+            'tts_concurrency': self.spin_tts_concurrency.value(),
+            'use_audio_cache': self.cb_audio_cache.isChecked(),
+            'stream_tts': self.cb_stream_tts.isChecked(),
+            'chunk_max_chars': self.spin_chunk_chars.value(),
             'voice_mappings': {
                 'vietnamese': self.combo_vn_voice.currentData(),
                 'japanese': self.combo_jp_voice.currentData(),
@@ -2391,19 +4816,12 @@ Ví dụ:
         self.log("🔗 Đang ghép audio...")
         
         try:
-            import wave
-            
             output_file = os.path.join(
                 self.output_path.text(),
                 self.output_filename.text()
             )
             
-            with wave.open(output_file, 'wb') as output:
-                for i, file_path in enumerate(self.audio_files):
-                    with wave.open(file_path, 'rb') as input_file:
-                        if i == 0:
-                            output.setparams(input_file.getparams())
-                        output.writeframes(input_file.readframes(input_file.getnframes()))
+            merge_wav_files(self.audio_files, output_file)
             
             self.log(f"✅ Đã ghép: {output_file}")
             QMessageBox.information(self, "Thành công", f"Đã ghép thành:\n{output_file}")
@@ -2495,11 +4913,15 @@ Ví dụ:
             if reply == QMessageBox.StandardButton.Yes:
                 self.tts_worker.cancel()
                 self.tts_worker.wait(3000)
+                self.gemini_api.close()
+                shutdown_analysis_pool()
                 event.accept()
             else:
                 event.ignore()
         else:
             save_prompts(self.prompts)
+            self.gemini_api.close()
+            shutdown_analysis_pool()
             event.accept()
 
 # =====================================
@@ -2549,9 +4971,7 @@ def check_dependencies():
     except ImportError:
         missing.append("requests")
     
-    try:
-        from google import genai
-    except ImportError:
+    if not GENAI_AVAILABLE:
         missing.append("google-genai")
     
     if missing:
@@ -2629,6 +5049,7 @@ def main_app():
         return 1
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # THÊM: process pool phân tích văn bản khi đóng gói exe
     print("🚀 Bilingual TTS Pro v6.0 - FIXED VERSION")
     print("👨‍💻 Phạm Hữu Tiền")
     print()